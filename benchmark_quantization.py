@@ -0,0 +1,105 @@
+import os
+import glob
+import time
+import random
+import argparse
+import pandas as pd
+import torch
+from tabulate import tabulate
+import whisper
+
+from evaluate import process_transcript, word_edit_distance
+from transcribe_segments import load_mel
+
+def sample_segments(extracted_dir, csv_file, ref_column, n_segments, seed=0):
+    """
+    Pick a reproducible random slice of the extracted segments that have a reference transcription.
+    
+    Returns:
+    list: (audio file, reference) pairs
+    """
+    df = pd.read_csv(csv_file)
+    references = {
+        (filename, timestamp): ref
+        for filename, timestamp, ref in zip(df['filename'], df['timestamp'], df[ref_column].map(process_transcript))
+        if ref
+    }
+    
+    segments = []
+    for audio_file in sorted(glob.glob(os.path.join(extracted_dir, "**/*.wav"), recursive=True)):
+        parts = os.path.basename(audio_file).split('_')
+        key = (parts[0], '_'.join(parts[1:3]).replace('.wav', ''))
+        if key in references:
+            segments.append((audio_file, references[key]))
+    
+    random.Random(seed).shuffle(segments)
+    return segments[:n_segments]
+
+def benchmark(model_name, segments, quantize, beam_size):
+    """
+    Transcribe the segments on CPU, in fp32 or with int8 Linear layers.
+    
+    Returns:
+    dict: Model load time, mean decode time per segment and WER
+    """
+    start = time.perf_counter()
+    model = whisper.load_model(model_name, device="cpu", quantize=quantize)
+    load_time = time.perf_counter() - start
+    options = whisper.DecodingOptions(task="transcribe", language="en", beam_size=beam_size, fp16=False)
+    
+    mels = [load_mel(audio_file, model.dims.n_mels) for audio_file, _ in segments]
+    whisper.decode(model, mels[0], options)  # warm up
+    
+    decode_time, word_errors, ref_words = 0.0, 0, 0
+    for mel, (_, ref) in zip(mels, segments):
+        start = time.perf_counter()
+        result = whisper.decode(model, mel, options)
+        decode_time += time.perf_counter() - start
+        word_errors += word_edit_distance(ref, process_transcript(result.text))
+        ref_words += len(ref.split())
+    
+    return {
+        "load": load_time,
+        "decode": decode_time / len(segments),
+        "wer": word_errors / ref_words * 100 if ref_words > 0 else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the speed and WER of int8 quantization against fp32 on CPU")
+    parser.add_argument("extracted_dir", help="Directory containing extracted audio segments")
+    parser.add_argument("csv_file", help="Path to the CSV file with reference transcriptions")
+    parser.add_argument("--model", "-m", default="base",
+                        help="Whisper model to use (tiny, base, small, medium, large)")
+    parser.add_argument("--ref", default="cleaned_utterance",
+                        help="Column name for reference transcriptions")
+    parser.add_argument("--segments", "-n", type=int, default=200,
+                        help="Number of segments in the held-out slice")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for picking the slice")
+    parser.add_argument("--beam-size", type=int, default=10,
+                        help="Beam size for decoding")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of CPU threads for PyTorch")
+    args = parser.parse_args()
+    
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    
+    segments = sample_segments(args.extracted_dir, args.csv_file, args.ref, args.segments, args.seed)
+    if not segments:
+        print("No extracted segments with a reference transcription were found")
+        return
+    print(f"Benchmarking {args.model} on {len(segments)} segments")
+    
+    fp32 = benchmark(args.model, segments, False, args.beam_size)
+    int8 = benchmark(args.model, segments, True, args.beam_size)
+    
+    rows = [
+        [name, f"{r['load']:.1f}", f"{r['decode'] * 1000:.0f}", f"{r['wer']:.2f}%"]
+        for name, r in (("fp32", fp32), ("int8", int8))
+    ]
+    print(tabulate(rows, headers=["Mode", "Load (s)", "Decode (ms/segment)", "WER"]))
+    print(f"\nSpeedup: {fp32['decode'] / int8['decode']:.2f}x, WER delta: {int8['wer'] - fp32['wer']:+.2f} points")
+
+if __name__ == "__main__":
+    main()
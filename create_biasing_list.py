@@ -5,7 +5,7 @@ import os
 import nltk
 from nltk.corpus import stopwords
 
-def parse_csv_and_write_to_txt(csv_file, output_folder, filename_start=None, error_start_letter='p', normalize=False, filter_stopwords=False):
+def parse_csv_and_write_to_txt(csv_file, output_folder, filename_start=None, error_start_letter='p', normalize=False, filter_stopwords=False, tokenizer=None):
     # Load the CSV file
     df = pd.read_csv(csv_file)
     
@@ -92,6 +92,13 @@ def parse_csv_and_write_to_txt(csv_file, output_folder, filename_start=None, err
         
         print(f"Created biasing list for {unique_filename} with {len(sorted_words)} words")
         
+        # Save the compiled trie next to the list, so decoding can skip tokenizing it
+        if tokenizer is not None:
+            from whisper.decoding import build_dict_trie, compiled_dict_trie_path
+            trie_path = compiled_dict_trie_path(output_path)
+            build_dict_trie(output_path, tokenizer).save(trie_path)
+            print(f"  Saved compiled trie to {trie_path}")
+        
         # Print removed words if filtering was enabled
         if filter_stopwords:
             total_removed = sum(len(words) for words in removed_words.values())
@@ -111,6 +118,8 @@ def main():
     parser.add_argument("--error-start", "-e", default='p', help="Starting letter of error_type to filter by")
     parser.add_argument("--normalize", "-n", action="store_true", help="Normalize words by removing parentheses and their contents")
     parser.add_argument("--filter-stopwords", "-f", action="store_true", help="Filter out common stopwords and single characters")
+    parser.add_argument("--compile-tries", "-c", action="store_true", help="Also save the compiled biasing trie of each list as biasing_list_<filename>.trie")
+    parser.add_argument("--english-only", action="store_true", help="Compile the tries for English-only (.en) Whisper models")
     
     args = parser.parse_args()
     
@@ -128,8 +137,14 @@ def main():
     output_folder = os.path.join("output", f"biasing_list_{common_prefix}")
     os.makedirs(output_folder, exist_ok=True)
     
+    # Tokenize the lists the same way the decoder does, if compiled tries are requested
+    tokenizer = None
+    if args.compile_tries:
+        from whisper.tokenizer import get_tokenizer
+        tokenizer = get_tokenizer(not args.english_only, language="en", task="transcribe")
+    
     # Process the specified CSV file
-    parse_csv_and_write_to_txt(args.csv_file, output_folder, args.filename_start, args.error_start, args.normalize, args.filter_stopwords)
+    parse_csv_and_write_to_txt(args.csv_file, output_folder, args.filename_start, args.error_start, args.normalize, args.filter_stopwords, tokenizer)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
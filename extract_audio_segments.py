@@ -3,8 +3,21 @@ import argparse
 import pandas as pd
 import subprocess
 import glob
+import wave
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 from tqdm import tqdm
 
+# Records how each extracted segment was produced, in the output directory
+MANIFEST_NAME = 'manifest.json'
+
+# Marks an output directory holding log-Mel spectrograms instead of WAV segments
+MEL_STORE_NAME = 'mel_store.json'
+SAMPLE_RATE = 16000
+N_FRAMES = 3000  # frames in the spectrogram of a 30-second Whisper input
+
 def find_audio_file(participant_id, audio_dir):
     """
     Find the audio file for a given participant ID in the audio directory.
@@ -78,19 +91,364 @@ def extract_audio_segment(audio_file, start_time, end_time, output_file):
         print(f"Error extracting audio segment: {str(e)}")
         return False
 
-def process_csv(csv_file, audio_dir, output_dir, timestamp_col='timestamp', filename_col='filename'):
+def decode_audio_file(audio_file, sample_rate=16000):
+    """
+    Decode a whole audio file once into 16-bit mono samples using ffmpeg.
+    
+    Parameters:
+    audio_file (str): Path to the input audio file
+    sample_rate (int): Sample rate to resample to
+    
+    Returns:
+    numpy.ndarray: The int16 samples, or None if decoding failed
+    """
+    cmd = [
+        'ffmpeg',
+        '-nostdin',
+        '-i', audio_file,  # Input file
+        '-f', 's16le',  # Raw samples on stdout
+        '-acodec', 'pcm_s16le',
+        '-ar', str(sample_rate),
+        '-ac', '1',
+        '-'
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(f"Error decoding {audio_file}: {result.stderr.decode()}")
+        return None
+    return np.frombuffer(result.stdout, dtype='<i2')
+
+def write_audio_segment(samples, start_time, end_time, output_file, sample_rate=16000):
+    """
+    Write the samples between two times as a 16 kHz mono pcm_s16le WAV file.
+    
+    Parameters:
+    samples (numpy.ndarray): The int16 samples of the whole recording
+    start_time (float): Start time in seconds
+    end_time (float): End time in seconds
+    output_file (str): Path to save the extracted segment
+    sample_rate (int): Sample rate of the samples
+    
+    Returns:
+    bool: True if the segment was written, False otherwise
+    """
+    segment = samples[round(start_time * sample_rate):round(end_time * sample_rate)]
+    if len(segment) == 0:
+        print(f"Error extracting segment: {start_time}-{end_time}s is outside the recording")
+        return False
+    
+    try:
+        # Create the output directory if it doesn't exist
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        
+        with wave.open(output_file, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(segment.tobytes())
+        return True
+    
+    except Exception as e:
+        print(f"Error writing audio segment: {str(e)}")
+        return False
+
+def load_manifest(output_dir):
+    """
+    Load the manifest of extracted segments, or an empty one if there is none.
+    
+    The manifest records the size, modification time and SHA-256 of each source recording,
+    and for each segment (keyed by its path relative to output_dir) the hash of the
+    source it was cut from and its start and end in milliseconds.
+    """
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"sources": {}, "segments": {}}
+
+def save_manifest(manifest, output_dir):
+    """
+    Save the manifest of output_dir; the previous one stays in place until the new one is written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def source_fingerprint(audio_file, known=None):
+    """
+    Return the size, modification time and SHA-256 of a source recording.
+    The file is only hashed again if its size or modification time changed since known.
+    """
+    stat = os.stat(audio_file)
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known
+    
+    sha256 = hashlib.sha256()
+    with open(audio_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+
+def is_segment_current(output_file, entry, start_ms, end_ms, sample_rate=16000):
+    """
+    Check whether an extracted segment can be kept. With a manifest entry, it must match the
+    segment; without one, the file must be a 16 kHz mono pcm_s16le WAV of the expected duration.
+    
+    Parameters:
+    output_file (str): Path of the extracted segment
+    entry (dict): The manifest entry expected for the segment, or None if it has none
+    start_ms (int): Start time in milliseconds
+    end_ms (int): End time in milliseconds
+    sample_rate (int): Sample rate of the extracted segments
+    
+    Returns:
+    bool: True if the segment does not need to be extracted again
+    """
+    if not os.path.exists(output_file):
+        return False
+    if entry is not None:
+        return True
+    
+    try:
+        with wave.open(output_file, 'rb') as f:
+            expected_frames = (end_ms - start_ms) * sample_rate // 1000
+            return (
+                f.getnchannels() == 1
+                and f.getsampwidth() == 2
+                and f.getframerate() == sample_rate
+                and abs(f.getnframes() - expected_frames) <= sample_rate // 100  # 10 ms
+            )
+    except (wave.Error, EOFError):
+        return False
+
+def extract_participant_segments(participant_id, segments, audio_dir, output_dir, single_pass=True, source=None, entries=None, force=False):
+    """
+    Extract all the segments of one participant from their source recording, skipping the
+    segments which are already up to date.
+    
+    Parameters:
+    participant_id (str): The participant ID
+    segments (list): (timestamp, start_ms, end_ms) of each segment
+    audio_dir (str): Directory containing audio files
+    output_dir (str): Directory to save extracted segments
+    single_pass (bool): Decode the recording once and slice the segments from it
+    source (dict): The manifest record of the source recording from the previous run
+    entries (dict): The manifest entries of the participant's segments from the previous run
+    force (bool): Extract every segment again
+    
+    Returns:
+    tuple: Number of extracted segments, number of skipped segments, the manifest record
+    of the source recording and the manifest entries of the extracted and skipped segments
+    """
+    audio_file = find_audio_file(participant_id, audio_dir)
+    if not audio_file:
+        print(f"Warning: Could not find audio file for {participant_id}")
+        return 0, 0, None, {}
+    
+    source = source_fingerprint(audio_file, source)
+    entries = entries or {}
+    
+    # Keep the segments cut from the same source before, and find the ones to extract
+    current, missing = {}, []
+    for timestamp, start_ms, end_ms in segments:
+        relative_path = os.path.join(participant_id, f"{participant_id}_{timestamp}.wav")
+        entry = {"source_sha256": source["sha256"], "start_ms": start_ms, "end_ms": end_ms}
+        previous = entries.get(relative_path)
+        if not force and previous in (entry, None) and is_segment_current(
+            os.path.join(output_dir, relative_path), previous, start_ms, end_ms
+        ):
+            current[relative_path] = entry
+        else:
+            missing.append((relative_path, entry))
+    
+    if missing and single_pass:
+        samples = decode_audio_file(audio_file)
+        if samples is None:
+            return 0, len(current), source, current
+    
+    success_count = 0
+    for relative_path, entry in missing:
+        output_file = os.path.join(output_dir, relative_path)
+        start_sec, end_sec = entry["start_ms"] / 1000.0, entry["end_ms"] / 1000.0
+        
+        # Extract the segment
+        if single_pass:
+            extracted = write_audio_segment(samples, start_sec, end_sec, output_file)
+        else:
+            extracted = extract_audio_segment(audio_file, start_sec, end_sec, output_file)
+        if extracted:
+            current[relative_path] = entry
+            success_count += 1
+    
+    return success_count, len(current) - success_count, source, current
+
+def extract_participant_mels(participant_id, segments, audio_dir, output_dir, n_mels=80, source=None, force=False):
+    """
+    Compute the log-Mel spectrograms of all the segments of one participant straight from the
+    decoded source recording, and store them as one shard of a mel store: <participant>.mel.npy,
+    of shape (n_segments, n_mels, 3000) in float32, the precision of the spectrograms computed
+    from WAV files, and <participant>.mel.json, which lists the timestamp of each row. The shard
+    is skipped if it was computed from the same source recording for the same segments.
+    
+    Parameters:
+    participant_id (str): The participant ID
+    segments (list): (timestamp, start_ms, end_ms) of each segment
+    audio_dir (str): Directory containing audio files
+    output_dir (str): Directory of the mel store
+    n_mels (int): Number of Mel-frequency filters of the Whisper model, 80 or 128
+    source (dict): The manifest record of the source recording from the previous run
+    force (bool): Compute the shard again
+    
+    Returns:
+    tuple: Number of computed segments, number of skipped segments, the manifest record
+    of the source recording and an empty dict, as no segment files are written
+    """
+    # only this mode needs torch, through whisper
+    from whisper.audio import log_mel_spectrogram, pad_or_trim
+    
+    audio_file = find_audio_file(participant_id, audio_dir)
+    if not audio_file:
+        print(f"Warning: Could not find audio file for {participant_id}")
+        return 0, 0, None, {}
+    
+    source = source_fingerprint(audio_file, source)
+    shard_path = os.path.join(output_dir, f"{participant_id}.mel.npy")
+    meta_path = os.path.join(output_dir, f"{participant_id}.mel.json")
+    meta = {
+        "source_sha256": source["sha256"],
+        "n_mels": n_mels,
+        "dtype": "float32",  # shards of older runs were float16, and are computed again
+        "timestamps": [timestamp for timestamp, _, _ in segments],
+    }
+    if not force and os.path.exists(shard_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            previous = json.load(f)
+        if {key: previous.get(key) for key in meta} == meta:
+            return 0, len(segments) - len(previous.get("missing", [])), source, {}
+    
+    samples = decode_audio_file(audio_file)
+    if samples is None:
+        return 0, 0, source, {}
+    
+    # Fill the shard on disk, so a long recording never holds all its spectrograms in memory
+    os.makedirs(output_dir, exist_ok=True)
+    mels = np.lib.format.open_memmap(shard_path + ".tmp", mode='w+', dtype=np.float32, shape=(len(segments), n_mels, N_FRAMES))
+    missing = []
+    for row, (timestamp, start_ms, end_ms) in enumerate(segments):
+        segment = samples[start_ms * SAMPLE_RATE // 1000:end_ms * SAMPLE_RATE // 1000]
+        if len(segment) == 0:
+            print(f"Error extracting segment: {timestamp} is outside the recording of {participant_id}")
+            missing.append(timestamp)
+            continue
+        audio = pad_or_trim(segment.astype(np.float32) / 32768.0)
+        mels[row] = log_mel_spectrogram(audio, n_mels=n_mels).numpy()
+    mels.flush()
+    del mels
+    os.replace(shard_path + ".tmp", shard_path)
+    
+    meta["missing"] = missing
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".tmp", meta_path)
+    
+    return len(segments) - len(missing), 0, source, {}
+
+class MelStore:
+    """
+    Reads the log-Mel spectrograms written by extract_participant_mels, memory-mapping each
+    participant's shard when one of its segments is first loaded.
+    """
+    
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MEL_STORE_NAME)) as f:
+            self.n_mels = json.load(f)["n_mels"]
+        
+        # (filename, timestamp) -> row of the participant's shard
+        self.rows = {}
+        for meta_path in sorted(glob.glob(os.path.join(store_dir, "*.mel.json"))):
+            participant_id = os.path.basename(meta_path)[:-len(".mel.json")]
+            with open(meta_path) as f:
+                meta = json.load(f)
+            missing = set(meta.get("missing", []))
+            for row, timestamp in enumerate(meta["timestamps"]):
+                if timestamp not in missing:
+                    self.rows[(participant_id, timestamp)] = row
+        self.shards = {}
+    
+    @staticmethod
+    def is_store(directory):
+        return os.path.exists(os.path.join(directory, MEL_STORE_NAME))
+    
+    def keys(self):
+        return list(self.rows)
+    
+    def load(self, key):
+        """
+        Return the spectrogram of the segment (filename, timestamp) in float32, shape (n_mels, 3000)
+        """
+        participant_id = key[0]
+        if participant_id not in self.shards:
+            shard_path = os.path.join(self.store_dir, f"{participant_id}.mel.npy")
+            self.shards[participant_id] = np.load(shard_path, mmap_mode='r')
+        return np.asarray(self.shards[participant_id][self.rows[key]], dtype=np.float32)
+
+def run_extraction(tasks, jobs=1, extract=extract_participant_segments):
+    """
+    Run extract (extract_participant_segments or extract_participant_mels) for each task,
+    in jobs worker processes if jobs > 1.
+    
+    Parameters:
+    tasks (list): (participant_id, keyword arguments) of each participant
+    jobs (int): Number of worker processes
+    extract (function): The function extracting the segments of one participant
+    
+    Yields:
+    tuple: The task and its result, or the exception it raised, as each participant completes
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(extract, **kwargs): (participant_id, kwargs) for participant_id, kwargs in tasks}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+    else:
+        for participant_id, kwargs in tasks:
+            try:
+                yield (participant_id, kwargs), extract(**kwargs)
+            except Exception as e:
+                yield (participant_id, kwargs), e
+
+def process_csv(csv_file, audio_dir, output_dir, timestamp_col='timestamp', filename_col='filename', single_pass=True, jobs=1, force=False, mel_store=False, n_mels=80):
     """
     Process a CSV file with timestamps and extract audio segments.
     
+    Rows are grouped by participant, so each source recording is opened once. With
+    single_pass, it is also decoded once and every segment is sliced from the samples;
+    otherwise ffmpeg is run on the source for each segment. With jobs > 1, participants
+    are shared between that many worker processes. Segments already extracted from the
+    same source recording are skipped, unless force is set. With mel_store, no WAV files
+    are written: output_dir becomes a mel store of the segments' log-Mel spectrograms,
+    which transcribe_segments.py reads directly.
+    
     Parameters:
     csv_file (str): Path to the CSV file
     audio_dir (str): Directory containing audio files
     output_dir (str): Directory to save extracted segments
     timestamp_col (str): Name of the column containing timestamps
     filename_col (str): Name of the column containing filenames
+    single_pass (bool): Decode each source recording once instead of once per segment
+    jobs (int): Number of worker processes
+    force (bool): Extract every segment again
+    mel_store (bool): Store the log-Mel spectrograms of the segments instead of WAV files
+    n_mels (int): Number of Mel-frequency filters of the Whisper model, for mel_store
     
     Returns:
-    int: Number of successfully extracted segments
+    int: Number of successfully extracted or up-to-date segments
     """
     try:
         # Read the CSV file
@@ -105,50 +463,88 @@ def process_csv(csv_file, audio_dir, output_dir, timestamp_col='timestamp', file
             print(f"Error: CSV file does not have a '{filename_col}' column")
             return 0
         
-        # Create a dictionary to cache audio file paths
-        audio_file_cache = {}
+        # Collect the segments of each participant
+        participants = []
+        for participant_id, rows in df.groupby(filename_col, sort=False):
+            # Parse the timestamps of the participant (format: start_end)
+            segments = []
+            for i, timestamp in rows[timestamp_col].items():
+                # Skip if timestamp is missing
+                if pd.isna(timestamp) or not timestamp:
+                    continue
+                
+                try:
+                    start_ms, end_ms = map(int, timestamp.split('_'))
+                    segments.append((timestamp, start_ms, end_ms))
+                except ValueError:
+                    print(f"Warning: Invalid timestamp format for row {i}: {timestamp}")
+            
+            participants.append((participant_id, segments, len(rows)))
+        
+        # Hand each participant what the manifest knows about their recording and segments
+        manifest = load_manifest(output_dir)
+        tasks, n_rows = [], {}
+        for participant_id, segments, rows_count in participants:
+            n_rows[participant_id] = rows_count
+            if not segments:
+                continue
+            kwargs = dict(
+                participant_id=participant_id,
+                segments=segments,
+                audio_dir=audio_dir,
+                output_dir=output_dir,
+                source=manifest["sources"].get(participant_id),
+                force=force,
+            )
+            if mel_store:
+                kwargs.update(n_mels=n_mels)
+            else:
+                prefix = participant_id + os.sep
+                kwargs.update(
+                    single_pass=single_pass,
+                    entries={path: entry for path, entry in manifest["segments"].items() if path.startswith(prefix)},
+                )
+            tasks.append((participant_id, kwargs))
+        
+        if mel_store:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(os.path.join(output_dir, MEL_STORE_NAME), "w") as f:
+                json.dump({"n_mels": n_mels}, f)
         
         # Count successful extractions
         success_count = 0
+        skipped_count = 0
+        failures = []
         
-        # Process each row
-        for i, row in tqdm(df.iterrows(), total=len(df), desc="Extracting audio segments"):
-            # Get the timestamp and filename
-            timestamp = row[timestamp_col]
-            participant_id = row[filename_col]
-            
-            # Skip if timestamp is missing
-            if pd.isna(timestamp) or not timestamp:
-                continue
-            
-            # Parse the timestamp (format: start_end)
-            try:
-                start_ms, end_ms = map(int, timestamp.split('_'))
-                start_sec = start_ms / 1000.0
-                end_sec = end_ms / 1000.0
-            except ValueError:
-                print(f"Warning: Invalid timestamp format for row {i}: {timestamp}")
-                continue
+        progress = tqdm(total=len(df), desc="Extracting audio segments")
+        progress.update(sum(rows_count for participant_id, segments, rows_count in participants if not segments))
+        extract = extract_participant_mels if mel_store else extract_participant_segments
+        for (participant_id, kwargs), result in run_extraction(tasks, jobs, extract):
+            if isinstance(result, Exception):
+                print(f"Error extracting segments of {participant_id}: {str(result)}")
+                result = (0, 0, None, {})
+            extracted, skipped, source, entries = result
+            success_count += extracted
+            skipped_count += skipped
+            if extracted + skipped < len(kwargs["segments"]):
+                failures.append((participant_id, len(kwargs["segments"]) - extracted - skipped))
             
-            # Find the audio file if not already cached
-            if participant_id not in audio_file_cache:
-                audio_file = find_audio_file(participant_id, audio_dir)
-                if not audio_file:
-                    print(f"Warning: Could not find audio file for {participant_id}")
-                    continue
-                audio_file_cache[participant_id] = audio_file
-            else:
-                audio_file = audio_file_cache[participant_id]
-            
-            # Create output filename
-            output_subdir = os.path.join(output_dir, participant_id)
-            output_file = os.path.join(output_subdir, f"{participant_id}_{timestamp}.wav")
-            
-            # Extract the segment
-            if extract_audio_segment(audio_file, start_sec, end_sec, output_file):
-                success_count += 1
+            # Record the participant's current segments in the manifest
+            if source is not None:
+                manifest["sources"][participant_id] = source
+                for path in kwargs.get("entries", {}):
+                    manifest["segments"].pop(path, None)
+                manifest["segments"].update(entries)
+            progress.update(n_rows[participant_id])
+        progress.close()
+        save_manifest(manifest, output_dir)
+        
+        for participant_id, n_failed in failures:
+            print(f"Warning: {n_failed} segments of {participant_id} were not extracted")
+        if skipped_count:
+            print(f"Skipped {skipped_count} segments which were already up to date")
         
-        return success_count
+        return success_count + skipped_count
     
     except Exception as e:
         print(f"Error processing CSV: {str(e)}")
@@ -165,6 +561,16 @@ def main():
                         help='Name of the column containing timestamps (default: timestamp)')
     parser.add_argument('--filename-col', '-f', default='filename',
                         help='Name of the column containing filenames (default: filename)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of participants to extract in parallel (default: 1)')
+    parser.add_argument('--force', action='store_true',
+                        help='Extract every segment again, even if it is already up to date')
+    parser.add_argument('--mel-store', action='store_true',
+                        help='Store the log-Mel spectrograms of the segments in the output directory instead of WAV files')
+    parser.add_argument('--n-mels', type=int, default=80, choices=[80, 128],
+                        help='Number of Mel-frequency filters for --mel-store: 80, or 128 for large-v3 (default: 80)')
+    parser.add_argument('--per-segment', action='store_true',
+                        help='Run ffmpeg on the source recording for each segment, instead of decoding each recording once')
     
     args = parser.parse_args()
     
@@ -174,10 +580,15 @@ def main():
         args.audio_dir,
         args.output_dir,
         args.timestamp_col,
-        args.filename_col
+        args.filename_col,
+        not args.per_segment,
+        args.jobs,
+        args.force,
+        args.mel_store,
+        args.n_mels
     )
     
-    print(f"\nExtraction complete. Successfully extracted {success_count} audio segments.")
+    print(f"\nExtraction complete. {success_count} audio segments are extracted and up to date.")
     print(f"Segments saved to: {os.path.abspath(args.output_dir)}")
 
 if __name__ == "__main__":
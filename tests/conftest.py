@@ -0,0 +1,56 @@
+import random as rand
+
+import numpy
+import pytest
+import torch
+
+from whisper.model import ModelDimensions, Whisper
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "requires_cuda")
+
+
+@pytest.fixture
+def random():
+    rand.seed(42)
+    numpy.random.seed(42)
+    torch.manual_seed(42)
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    # a randomly initialized model with the multilingual vocabulary, small enough to decode on CPU
+    torch.manual_seed(0)
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=64,
+        n_audio_head=4,
+        n_audio_layer=2,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=64,
+        n_text_head=4,
+        n_text_layer=2,
+    )
+    model = Whisper(dims).eval()
+    # the default initialization decodes the same token for any audio; wider weights do not
+    with torch.no_grad():
+        for parameter in model.parameters():
+            if parameter.dim() > 1:
+                parameter.normal_(0, 1)
+    return model
+
+
+@pytest.fixture(scope="session")
+def mels():
+    # the spectrograms of a few seconds of noise each, padded to 30 seconds
+    from whisper.audio import log_mel_spectrogram, pad_or_trim
+
+    generator = numpy.random.default_rng(0)
+    audio = [
+        pad_or_trim(generator.standard_normal(16000 * (i + 2)).astype(numpy.float32) * 0.1)
+        for i in range(4)
+    ]
+    return torch.stack([log_mel_spectrogram(a) for a in audio])
@@ -0,0 +1,435 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import whisper
+from whisper.decoding import (
+    BeamSearchDecoder,
+    DecodingTask,
+    DictTrie,
+    LogitFilter,
+    PyTorchInference,
+    compiled_dict_trie_path,
+    load_dict_trie,
+)
+from whisper.model import MultiHeadAttention
+from whisper.tokenizer import get_tokenizer
+from whisper.utils import close_trace_writers
+
+
+def decode_options(**kwargs):
+    # short decodes of the tiny model, on CPU
+    options = dict(language="en", beam_size=3, sample_len=12, fp16=False, without_timestamps=True)
+    options.update(kwargs)
+    return whisper.DecodingOptions(**options)
+
+
+@pytest.mark.parametrize("beam_size", [None, 3])
+def test_batched_decode_matches_single(tiny_model, mels, beam_size):
+    options = decode_options(beam_size=beam_size)
+    single = [whisper.decode(tiny_model, mel, options) for mel in mels]
+    batched = whisper.decode(tiny_model, mels, options)
+
+    assert len(batched) == len(mels)
+    for expected, result in zip(single, batched):
+        assert result.tokens == expected.tokens
+        assert result.avg_logprob == pytest.approx(expected.avg_logprob, abs=1e-4)
+        assert torch.allclose(result.audio_features, expected.audio_features, atol=1e-4)
+
+
+class ConcatCacheInference(PyTorchInference):
+    """
+    The key/value cache as it was before KVCache: each new token is concatenated to the cache,
+    and beam search selects the rows of every cached tensor into new ones
+    """
+
+    def logits(self, tokens, audio_features):
+        if not self.kv_cache:
+            self.kv_cache, self.hooks = {}, []
+
+            def save_to_cache(module, _, output):
+                if module not in self.kv_cache or output.shape[1] > self.model.dims.n_text_ctx:
+                    self.kv_cache[module] = output
+                else:
+                    self.kv_cache[module] = torch.cat([self.kv_cache[module], output], dim=1).detach()
+                return self.kv_cache[module]
+
+            for layer in self.model.decoder.modules():
+                if isinstance(layer, MultiHeadAttention):
+                    self.hooks.append(layer.key.register_forward_hook(save_to_cache))
+                    self.hooks.append(layer.value.register_forward_hook(save_to_cache))
+
+        if tokens.shape[-1] > self.initial_token_length:
+            tokens = tokens[:, -1:]
+        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+
+    def rearrange_kv_cache(self, source_indices):
+        if source_indices != list(range(len(source_indices))):
+            for module in self.kv_modules:
+                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+
+
+def test_kv_cache_matches_concatenated_cache(tiny_model, mels):
+    # beam search reorders the cache at most steps, through the spare buffers of KVCache
+    options = decode_options(beam_size=5, sample_len=30)
+    results = whisper.decode(tiny_model, mels, options)
+
+    task = DecodingTask(tiny_model, options)
+    task.inference = task.decoder.inference = ConcatCacheInference(tiny_model, len(task.initial_tokens))
+    expected = task.run(mels)
+
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+    for result, reference in zip(results, expected):
+        assert result.avg_logprob == pytest.approx(reference.avg_logprob, abs=1e-5)
+
+
+class ReferenceBiasDecoder(BeamSearchDecoder):
+    """
+    Per-candidate biasing of the beam search over tuple-keyed boost and ban DictTries, written
+    like the original loop, as a reference for the batched scoring: the match of a candidate
+    extends if the trie has the sequence, and otherwise goes back to the root. Unlike the
+    original, it scores every beam: there, completing a word overwrote the audio index, so
+    the remaining beams of the step were read from the wrong rows or skipped
+    """
+
+    def __init__(self, beam_size, eot, inference, dictionary, dict_coeff, ban_dictionary=None, ban_coeff=0.0):
+        super().__init__(beam_size, eot, inference)
+        self.dictionary = dictionary
+        self.dict_coeff = dict_coeff
+        self.ban_dictionary = ban_dictionary or DictTrie()
+        self.ban_coeff = ban_coeff
+        self.dict_logprobs = None
+        self.ban_dict_logprobs = None
+
+    def reset(self):
+        super().reset()
+        self.dict_logprobs = None
+        self.ban_dict_logprobs = None
+
+    @staticmethod
+    def match(dictionary, sequence, dict_logprob):
+        # the matched logprobs of a candidate, and its permanent and temporary scores
+        dictionary_sequence = sequence[-len(dict_logprob) :]
+        if dictionary_sequence not in dictionary.next_at_sequence:
+            return [], 0, 0
+        dict_logprob = dict_logprob[-len(dictionary_sequence) :]
+        perma_score = sum(
+            sum(dict_logprob[-end_length:])
+            for end_length in dictionary.end_at_sequence[dictionary_sequence]
+        )
+        temp_score = sum(dict_logprob) if dictionary.next_at_sequence[dictionary_sequence] else 0
+        return dict_logprob, perma_score, temp_score
+
+    def update(self, tokens, logits, sum_logprobs):
+        n_audio = tokens.shape[0] // self.beam_size
+        if self.finished_sequences is None:
+            self.finished_sequences = [{} for _ in range(n_audio)]
+            self.dict_logprobs = [[] for _ in range(tokens.shape[0])]
+            self.ban_dict_logprobs = [[] for _ in range(tokens.shape[0])]
+
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        next_tokens, source_indices, finished_sequences = [], [], []
+        dict_logprobs, ban_dict_logprobs = [], []
+        for i in range(n_audio):
+            scores, seq_dict_scores, seq_ban_dict_scores, total_scores, sources, finished = {}, {}, {}, {}, {}, {}
+            for j in range(self.beam_size):
+                idx = i * self.beam_size + j
+                prefix = tokens[idx].tolist()
+                for logprob, token in zip(*logprobs[idx].topk(3 * self.beam_size + 1)):
+                    new_logprob = (sum_logprobs[idx] + logprob).item()
+                    sequence = tuple(prefix + [token.item()])
+                    new_dict_logprob, perma_boost_score, temp_boost_score = self.match(
+                        self.dictionary, sequence, self.dict_logprobs[idx] + [logprob.item()]
+                    )
+                    new_ban_dict_logprob, perma_ban_score, temp_ban_score = self.match(
+                        self.ban_dictionary, sequence, self.ban_dict_logprobs[idx] + [logprob.item()]
+                    )
+                    new_logprob = new_logprob - self.dict_coeff * perma_boost_score
+                    new_logprob = new_logprob - self.ban_coeff * perma_ban_score
+                    total_scores[sequence] = (
+                        new_logprob - self.dict_coeff * temp_boost_score - self.ban_coeff * temp_ban_score
+                    )
+                    seq_dict_scores[sequence] = new_dict_logprob
+                    seq_ban_dict_scores[sequence] = new_ban_dict_logprob
+                    scores[sequence] = new_logprob
+                    sources[sequence] = idx
+
+            saved = 0
+            for sequence in sorted(total_scores, key=total_scores.get, reverse=True):
+                if sequence[-1] == self.eot:
+                    finished[sequence] = scores[sequence]
+                else:
+                    sum_logprobs[len(next_tokens)] = scores[sequence]
+                    dict_logprobs.append(seq_dict_scores[sequence])
+                    ban_dict_logprobs.append(seq_ban_dict_scores[sequence])
+                    next_tokens.append(sequence)
+                    source_indices.append(sources[sequence])
+                    saved += 1
+                    if saved == self.beam_size:
+                        break
+            finished_sequences.append(finished)
+
+        self.dict_logprobs = dict_logprobs
+        self.ban_dict_logprobs = ban_dict_logprobs
+        tokens = torch.tensor(next_tokens, device=tokens.device)
+        self.inference.rearrange_kv_cache(source_indices)
+        for previously_finished, newly_finished in zip(self.finished_sequences, finished_sequences):
+            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
+                if len(previously_finished) >= self.max_candidates:
+                    break
+                previously_finished[seq] = newly_finished[seq]
+
+        completed = all(
+            len(sequences) >= self.max_candidates for sequences in self.finished_sequences
+        )
+        return tokens, completed
+
+
+def biasing_words(model, mels, options):
+    # words made of the tokens the model decodes without biasing, so that biasing them matters
+    results = whisper.decode(model, mels, options)
+    words = []
+    for result in results:
+        tokens = result.tokens
+        words += [tokens[1:3], tokens[4:5], tokens[2:5]]
+    return [word for word in words if word]
+
+
+def biasing_dictionary(model, mels):
+    dictionary = DictTrie()
+    for word in biasing_words(model, mels, decode_options()):
+        dictionary.add_sequence(word)
+    dictionary.build_backoff()
+    return dictionary
+
+
+@pytest.mark.parametrize("dict_coeff", [0.5, 1.0, 3.0])
+def test_biased_decode_matches_reference(tiny_model, mels, dict_coeff):
+    options = decode_options()
+    dictionary = biasing_dictionary(tiny_model, mels)
+
+    biased = decode_options(dict_path=dictionary.compile(), dict_coeff=dict_coeff)
+    results = whisper.decode(tiny_model, mels, biased)
+
+    task = DecodingTask(tiny_model, biased)
+    task.decoder = ReferenceBiasDecoder(3, task.tokenizer.eot, task.inference, dictionary, dict_coeff)
+    expected = task.run(mels)
+
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+    assert [r.tokens for r in results] != [r.tokens for r in whisper.decode(tiny_model, mels, options)]
+
+
+@pytest.mark.parametrize("beam_size", [1, 5])
+def test_biased_decode_matches_reference_across_beam_sizes(tiny_model, mels, beam_size):
+    dictionary = biasing_dictionary(tiny_model, mels)
+    biased = decode_options(beam_size=beam_size, dict_path=dictionary.compile(), dict_coeff=1.0)
+    results = whisper.decode(tiny_model, mels, biased)
+
+    task = DecodingTask(tiny_model, biased)
+    task.decoder = ReferenceBiasDecoder(beam_size, task.tokenizer.eot, task.inference, dictionary, 1.0)
+    expected = task.run(mels)
+
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+
+
+@pytest.mark.parametrize("beam_size", [4, 8])
+def test_biased_decode_ranks_ties_like_reference(tiny_model, mels, beam_size):
+    # longer decodes at a low coefficient, where candidates with exactly tied scores occur
+    dictionary = biasing_dictionary(tiny_model, mels)
+    biased = decode_options(beam_size=beam_size, sample_len=30, dict_path=dictionary.compile(), dict_coeff=0.5)
+    results = whisper.decode(tiny_model, mels, biased)
+
+    task = DecodingTask(tiny_model, biased)
+    task.decoder = ReferenceBiasDecoder(beam_size, task.tokenizer.eot, task.inference, dictionary, 0.5)
+    expected = task.run(mels)
+
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+
+
+def test_boost_and_ban_decode_matches_reference(tiny_model, mels):
+    words = biasing_words(tiny_model, mels, decode_options())
+    boost, ban = DictTrie(), DictTrie()
+    for word in words:
+        # ban the words of several tokens, which carry a match across steps
+        (ban if len(word) > 1 else boost).add_sequence(word)
+    boost.build_backoff()
+    ban.build_backoff()
+
+    options = decode_options(
+        dict_path=boost.compile(), dict_coeff=1.0, ban_dict_path=ban.compile(), ban_dict_coeff=-2.0
+    )
+    results = whisper.decode(tiny_model, mels, options)
+
+    task = DecodingTask(tiny_model, options)
+    task.decoder = ReferenceBiasDecoder(3, task.tokenizer.eot, task.inference, boost, 1.0, ban, -2.0)
+    expected = task.run(mels)
+
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+    assert [r.tokens for r in results] != [r.tokens for r in whisper.decode(tiny_model, mels, decode_options())]
+
+
+@pytest.mark.parametrize("n_audio", [1, 4])
+def test_sweep_matches_single_coefficients(tiny_model, mels, n_audio):
+    trie = biasing_dictionary(tiny_model, mels).compile()
+    coeffs = [0.0, 1.0, 3.0]
+    mel = mels[0] if n_audio == 1 else mels
+    sweep = whisper.decode(tiny_model, mel, decode_options(dict_path=trie, dict_coeff=coeffs))
+
+    # ordered by coefficient, then by audio
+    assert len(sweep) == len(coeffs) * n_audio
+    for k, dict_coeff in enumerate(coeffs):
+        single = whisper.decode(tiny_model, mel, decode_options(dict_path=trie, dict_coeff=dict_coeff))
+        single = [single] if n_audio == 1 else single
+        assert [r.tokens for r in sweep[k * n_audio : (k + 1) * n_audio]] == [r.tokens for r in single]
+
+
+def test_per_audio_dictionaries_match_single_decodes(tiny_model, mels):
+    words = biasing_words(tiny_model, mels, decode_options())
+    first, second = DictTrie(), DictTrie()
+    for k, word in enumerate(words):
+        (first if k % 2 else second).add_sequence(word)
+    first.build_backoff()
+    second.build_backoff()
+    tries = [first.compile(), None, second.compile(), first.compile()]
+
+    batched = whisper.decode(tiny_model, mels, decode_options(dict_path=tries, dict_coeff=2.0))
+    for mel, trie, result in zip(mels, tries, batched):
+        single = whisper.decode(tiny_model, mel, decode_options(dict_path=trie, dict_coeff=2.0))
+        assert result.tokens == single.tokens
+
+
+def write_word_list(model, mels, path):
+    # the words of the unbiased transcriptions, one per row as in the biasing lists
+    words = {word for result in whisper.decode(model, mels, decode_options()) for word in result.text.split()}
+    path.write_text("".join(f"{word}\tword\n" for word in sorted(words)))
+    return sorted(words)
+
+
+def test_word_list_decode_matches_compiled_trie(tiny_model, mels, tmp_path):
+    words = write_word_list(tiny_model, mels, tmp_path / "words.txt")
+    assert words
+    tokenizer = get_tokenizer(tiny_model.is_multilingual, num_languages=tiny_model.num_languages, language="en", task="transcribe")
+    dictionary = DictTrie()
+    for word in words:
+        dictionary.add_sequence(tokenizer.encode(" " + word))
+    dictionary.build_backoff()
+
+    from_list = whisper.decode(tiny_model, mels, decode_options(dict_path=str(tmp_path / "words.txt"), dict_coeff=1.0))
+    compiled = whisper.decode(tiny_model, mels, decode_options(dict_path=dictionary.compile(), dict_coeff=1.0))
+    assert [r.tokens for r in from_list] == [r.tokens for r in compiled]
+
+    # the list is compiled once, and again only once it changes
+    trie = load_dict_trie(str(tmp_path / "words.txt"), tokenizer)
+    assert load_dict_trie(str(tmp_path / "words.txt"), tokenizer) is trie
+    (tmp_path / "words.txt").write_text("changed\tword\n")
+    mtime_ns = os.stat(tmp_path / "words.txt").st_mtime_ns
+    os.utime(tmp_path / "words.txt", ns=(mtime_ns, mtime_ns + 10**9))
+    assert load_dict_trie(str(tmp_path / "words.txt"), tokenizer) is not trie
+
+
+def test_saved_trie_decode_matches_word_list(tiny_model, mels, tmp_path):
+    write_word_list(tiny_model, mels, tmp_path / "words.txt")
+    tokenizer = get_tokenizer(tiny_model.is_multilingual, num_languages=tiny_model.num_languages, language="en", task="transcribe")
+    load_dict_trie(str(tmp_path / "words.txt"), tokenizer).save(str(tmp_path / "saved.trie"))
+
+    from_list = whisper.decode(tiny_model, mels, decode_options(dict_path=str(tmp_path / "words.txt"), dict_coeff=1.0))
+    from_file = whisper.decode(tiny_model, mels, decode_options(dict_path=str(tmp_path / "saved.trie"), dict_coeff=1.0))
+    assert [r.tokens for r in from_file] == [r.tokens for r in from_list]
+
+    # a trie saved next to the list is memory-mapped instead of rebuilt
+    os.replace(tmp_path / "saved.trie", compiled_dict_trie_path(str(tmp_path / "words.txt")))
+    os.utime(tmp_path / "words.txt", ns=(0, 0))
+    assert isinstance(load_dict_trie(str(tmp_path / "words.txt"), tokenizer).child_tokens, np.memmap)
+    next_to_list = whisper.decode(tiny_model, mels, decode_options(dict_path=str(tmp_path / "words.txt"), dict_coeff=1.0))
+    assert [r.tokens for r in next_to_list] == [r.tokens for r in from_list]
+
+
+@pytest.mark.parametrize("trace", ["summary", "full"])
+def test_trace_leaves_results_unchanged(tiny_model, mels, tmp_path, trace):
+    trie = biasing_dictionary(tiny_model, mels).compile()
+    options = decode_options(dict_path=trie, dict_coeff=1.0)
+    expected = whisper.decode(tiny_model, mels, options)
+    traced = whisper.decode(
+        tiny_model, mels, decode_options(dict_path=trie, dict_coeff=1.0, trace=trace, trace_file=str(tmp_path / "trace.jsonl"))
+    )
+    assert [r.tokens for r in traced] == [r.tokens for r in expected]
+    assert [r.avg_logprob for r in traced] == [r.avg_logprob for r in expected]
+
+
+def test_trace_records_name_their_audio(tiny_model, mels, tmp_path):
+    files = [f"segment_{i}.wav" for i in range(len(mels))]
+    trace_file = tmp_path / "trace.jsonl"
+    options = decode_options(transcription_file=files, trace="full", trace_file=str(trace_file))
+    task = DecodingTask(tiny_model, options)
+    task.run(mels)
+    close_trace_writers()  # flushes the file
+
+    records = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    assert records[0]["event"] == "start"
+    beams = [record for record in records if record["event"] == "beam"]
+    # one record per beam of every audio at each step, under the file of that audio
+    assert len(beams) == task.decoder.n_steps * len(files) * 3
+    for record in beams:
+        assert record["file"] == files[record["audio"]]
+
+
+def test_early_exit_is_off_by_default():
+    options = whisper.DecodingOptions()
+    assert options.beam_stop_bound is None and options.beam_prune_margin is None
+
+
+@pytest.mark.parametrize("biased", [False, True])
+def test_loose_early_exit_matches_full_search(tiny_model, mels, biased):
+    extra = dict(dict_path=biasing_dictionary(tiny_model, mels).compile(), dict_coeff=1.0) if biased else {}
+    full = whisper.decode(tiny_model, mels, decode_options(**extra))
+    loose = whisper.decode(
+        tiny_model, mels, decode_options(beam_stop_bound=1e9, beam_prune_margin=1e9, **extra)
+    )
+    assert [r.tokens for r in loose] == [r.tokens for r in full]
+    assert [r.avg_logprob for r in loose] == [r.avg_logprob for r in full]
+
+
+@pytest.mark.parametrize("beam_prune_margin", [0.0, 1.0])
+def test_pruned_decode_scores_are_finite(tiny_model, mels, beam_prune_margin):
+    # pruned beams are filled with -inf copies of a live one, which must not replace its score
+    results = whisper.decode(tiny_model, mels, decode_options(beam_prune_margin=beam_prune_margin))
+    assert all(np.isfinite(result.avg_logprob) for result in results)
+    assert all(len(result.tokens) > 0 for result in results)
+
+
+class EndAt(LogitFilter):
+    # makes the end of text the most likely token, by a margin of 1, at one sequence length only
+    def __init__(self, eot, length):
+        self.eot = eot
+        self.length = length
+
+    def apply(self, logits, tokens):
+        if tokens.shape[-1] == self.length:
+            logits[:, self.eot] = logits.max(dim=-1).values + 1
+
+
+@pytest.mark.parametrize("early_exit", [dict(beam_stop_bound=0.0), dict(beam_prune_margin=0.5)])
+def test_early_exit_stops_once_sequences_end(tiny_model, mels, early_exit):
+    # the beams of every audio end after 5 tokens; with patience 2, the full search needs twice
+    # as many finished sequences, which it never gets, so it runs to sample_len
+    runs = []
+    for options in (
+        decode_options(sample_len=64, patience=2.0),
+        decode_options(sample_len=64, patience=2.0, **early_exit),
+    ):
+        task = DecodingTask(tiny_model, options)
+        task.logit_filters.append(EndAt(task.tokenizer.eot, task.sample_begin + 5))
+        runs.append((task.run(mels), task.decoder.n_steps))
+    (full, full_steps), (early, early_steps) = runs
+
+    assert full_steps == 64
+    assert early_steps < full_steps
+    assert all(len(result.tokens) == 5 for result in early)
+    assert all(np.isfinite(result.avg_logprob) for result in early)
+    if "beam_stop_bound" in early_exit:
+        # the sequences which ended lead every live beam, so stopping early keeps them
+        assert [r.tokens for r in early] == [r.tokens for r in full]
@@ -0,0 +1,146 @@
+import os
+import random
+
+import pytest
+import torch
+
+from whisper.decoding import CompiledDictTrie, DictTrie, DictTrieCursor
+
+
+def make_dictionary(words):
+    dictionary = DictTrie()
+    for word in words:
+        dictionary.add_sequence(word)
+    dictionary.build_backoff()
+    return dictionary
+
+
+def random_words(rng, n_words=12, n_tokens=8):
+    # short words over few tokens, so that they share prefixes and contain each other
+    return [
+        [rng.randrange(n_tokens) for _ in range(rng.randint(1, 4))] for _ in range(n_words)
+    ]
+
+
+def reference_advance(dictionary, matched, logprobs, token, logprob):
+    """
+    One candidate scored as by a per-candidate beam search: the match extends if
+    the trie has the sequence, and otherwise goes back to the root
+    """
+    sequence = matched + (token,)
+    if sequence not in dictionary.next_at_sequence:
+        return (), [], 0.0, 0.0
+    logprobs = (logprobs + [logprob])[-len(sequence) :]
+    perma = sum(sum(logprobs[-length:]) for length in dictionary.end_at_sequence[sequence])
+    temp = sum(logprobs) if dictionary.next_at_sequence[sequence] else 0.0
+    return sequence, logprobs, perma, temp
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_cursor_matches_reference(seed):
+    rng = random.Random(seed)
+    dictionary = make_dictionary(random_words(rng))
+    trie = dictionary.compile()
+
+    n_batch, n_candidates = 6, 5
+    cursor = DictTrieCursor(trie, n_batch, torch.device("cpu"))
+    states = [((), [])] * n_batch
+    for _ in range(20):
+        tokens = torch.tensor(
+            [[rng.randrange(10) for _ in range(n_candidates)] for _ in range(n_batch)]
+        )
+        logprobs = -torch.rand(n_batch, n_candidates)
+        perma, temp = cursor.advance(tokens, logprobs)
+
+        candidates = []
+        for row, (matched, matched_logprobs) in enumerate(states):
+            node = trie.walk(matched)
+            for k in range(n_candidates):
+                token, logprob = tokens[row, k].item(), logprobs[row, k].item()
+                expected = reference_advance(dictionary, matched, matched_logprobs, token, logprob)
+                assert perma[row, k].item() == pytest.approx(expected[2], abs=1e-5)
+                assert temp[row, k].item() == pytest.approx(expected[3], abs=1e-5)
+                assert cursor.candidate_nodes[row, k].item() == trie.step(node, token)
+                assert trie.step(node, token) == trie.walk(expected[0])
+                candidates.append(expected[:2])
+
+        selected = torch.tensor([row * n_candidates + rng.randrange(n_candidates) for row in range(n_batch)])
+        cursor.update(selected)
+        states = [candidates[i] for i in selected.tolist()]
+
+
+def test_stacked_tries_match_each_trie(tmp_path):
+    rng = random.Random(0)
+    tries = [make_dictionary(random_words(rng)).compile() for _ in range(2)]
+    tries.append(DictTrie().compile())  # an audio without a dictionary
+
+    n_rows, n_candidates = 3, 4
+    stacked = DictTrieCursor(tries, n_rows * len(tries), torch.device("cpu"))
+    singles = [DictTrieCursor(trie, n_rows, torch.device("cpu")) for trie in tries]
+    for _ in range(15):
+        tokens = torch.randint(0, 10, (n_rows * len(tries), n_candidates))
+        logprobs = -torch.rand(n_rows * len(tries), n_candidates)
+        perma, temp = stacked.advance(tokens, logprobs)
+        selected = torch.randint(0, n_candidates, (n_rows * len(tries),))
+        for part, single in enumerate(singles):
+            rows = slice(part * n_rows, (part + 1) * n_rows)
+            single_perma, single_temp = single.advance(tokens[rows], logprobs[rows])
+            assert torch.allclose(perma[rows], single_perma)
+            assert torch.allclose(temp[rows], single_temp)
+            single.update(torch.arange(n_rows) * n_candidates + selected[rows])
+        stacked.update(torch.arange(n_rows * len(tries)) * n_candidates + selected)
+
+
+def test_saved_trie_matches_compiled(tmp_path):
+    trie = make_dictionary(random_words(random.Random(0))).compile("gpt2", True)
+    trie.save(str(tmp_path / "words.trie"))
+    loaded = CompiledDictTrie.load(str(tmp_path / "words.trie"))
+
+    assert (loaded.encoding_name, loaded.add_space) == ("gpt2", True)
+    for name in CompiledDictTrie.ARRAYS:
+        assert (getattr(loaded, name) == getattr(trie, name)).all(), name
+
+
+def test_many_large_tries_match_each_trie():
+    # one list of 2000 words per speaker, as in a batch of mixed speakers
+    rng = random.Random(0)
+    tries = [
+        make_dictionary(
+            [[rng.randrange(50000) for _ in range(rng.randint(1, 4))] for _ in range(2000)]
+        ).compile()
+        for _ in range(16)
+    ]
+
+    n_rows, n_candidates = 2, 4
+    stacked = DictTrieCursor(tries, n_rows * len(tries), torch.device("cpu"))
+    singles = [DictTrieCursor(trie, n_rows, torch.device("cpu")) for trie in tries]
+    # the stacked tables grow with the number of edges, not nodes times tokens
+    assert stacked.edge_keys.numel() == sum(len(trie.child_tokens) for trie in tries) + 1
+
+    for _ in range(6):
+        tokens = torch.randint(0, 50000, (n_rows * len(tries), n_candidates))
+        for part, (trie, single) in enumerate(zip(tries, singles)):
+            for row, node in enumerate(single.nodes.tolist()):
+                # the first candidate follows an edge of the trie, so that matches get deep
+                start, end = trie.child_offsets[node], trie.child_offsets[node + 1]
+                if end > start:
+                    tokens[part * n_rows + row, 0] = int(trie.child_tokens[rng.randrange(start, end)])
+        logprobs = -torch.rand(n_rows * len(tries), n_candidates)
+        perma, temp = stacked.advance(tokens, logprobs)
+        for part, single in enumerate(singles):
+            rows = slice(part * n_rows, (part + 1) * n_rows)
+            single_perma, single_temp = single.advance(tokens[rows], logprobs[rows])
+            assert torch.allclose(perma[rows], single_perma)
+            assert torch.allclose(temp[rows], single_temp)
+            single.update(torch.arange(n_rows) * n_candidates)
+        stacked.update(torch.arange(n_rows * len(tries)) * n_candidates)
+
+
+def test_saved_trie_grows_with_nodes(tmp_path):
+    rng = random.Random(0)
+    words = [[rng.randrange(50000) for _ in range(rng.randint(1, 4))] for _ in range(2000)]
+    trie = make_dictionary(words).compile()
+    trie.save(str(tmp_path / "words.trie"))
+    # no table of nodes times distinct tokens, which would take hundreds of bytes per node
+    per_node = os.path.getsize(tmp_path / "words.trie") / trie.n_nodes
+    assert per_node < 8 * (7 + trie.max_depth)
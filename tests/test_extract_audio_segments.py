@@ -0,0 +1,36 @@
+import json
+import os
+
+import numpy as np
+
+import extract_audio_segments
+from extract_audio_segments import MEL_STORE_NAME, MelStore, extract_participant_mels, write_audio_segment
+from transcribe_segments import load_mel
+
+SEGMENTS = [("0_2000", 0, 2000), ("2000_5000", 2000, 5000)]
+
+
+def test_mel_store_matches_wav_segments(tmp_path, monkeypatch):
+    samples = (np.random.default_rng(0).standard_normal(16000 * 6) * 3000).astype(np.int16)
+    audio_dir, store_dir = tmp_path / "audio", tmp_path / "mel_store"
+    os.makedirs(audio_dir)
+    (audio_dir / "adler01a.wav").touch()
+    # the source recording decodes to these samples, without running ffmpeg
+    monkeypatch.setattr(extract_audio_segments, "decode_audio_file", lambda audio_file: samples)
+
+    extracted, skipped, _, _ = extract_participant_mels("adler01a", SEGMENTS, str(audio_dir), str(store_dir))
+    assert (extracted, skipped) == (len(SEGMENTS), 0)
+    with open(store_dir / MEL_STORE_NAME, "w") as f:
+        json.dump({"n_mels": 80}, f)
+
+    store = MelStore(str(store_dir))
+    for timestamp, start_ms, end_ms in SEGMENTS:
+        wav_file = str(tmp_path / f"adler01a_{timestamp}.wav")
+        assert write_audio_segment(samples, start_ms / 1000, end_ms / 1000, wav_file)
+        expected = load_mel(wav_file, 80).numpy()
+        mel = store.load(("adler01a", timestamp))
+        assert mel.dtype == np.float32
+        np.testing.assert_allclose(mel, expected, atol=1e-6)
+
+    # an unchanged shard is not computed again
+    assert extract_participant_mels("adler01a", SEGMENTS, str(audio_dir), str(store_dir))[:2] == (0, len(SEGMENTS))
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+
+from whisper.decoding import AudioFeatureCache
+
+
+def test_put_and_get(tmp_path):
+    cache = AudioFeatureCache(str(tmp_path), max_bytes=1024**2)
+    features = np.random.default_rng(0).standard_normal((1500, 64)).astype(np.float16)
+    cache.put("key", features)
+
+    assert cache.get("missing") is None
+    assert (cache.get("key") == features).all()
+
+
+def test_get_survives_failed_touch(tmp_path, monkeypatch):
+    cache = AudioFeatureCache(str(tmp_path), max_bytes=1024**2)
+    features = np.ones((4, 8), dtype=np.float32)
+    cache.put("key", features)
+
+    def utime(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(os, "utime", utime)
+    assert (cache.get("key") == features).all()
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    features = np.ones((256, 256), dtype=np.float32)
+    cache = AudioFeatureCache(str(tmp_path), max_bytes=1024**3)
+    cache.put("0", features)
+    cache.max_bytes = 3 * os.path.getsize(cache._path("0"))  # room for three entries
+    for i in range(3):
+        cache.put(str(i), features)
+        os.utime(cache._path(str(i)), ns=(i, i))
+    cache.put("3", features)
+
+    assert cache.get("0") is None
+    assert all(cache.get(str(i)) is not None for i in range(1, 4))
@@ -0,0 +1,115 @@
+import json
+import os
+import queue
+import wave
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+import transcribe_segments
+from transcribe_segments import transcription_worker
+from whisper.utils import TraceWriter
+
+SEGMENTS = [("adler01a", "0_2000"), ("adler01a", "2000_5000"), ("kempler04a", "0_3000"), ("kempler04a", "3000_4000")]
+
+
+@pytest.fixture
+def corpus(tmp_path, tiny_model, monkeypatch):
+    # WAV segments in per-participant folders, their CSV, and a biasing list for one speaker only
+    extracted_dir = tmp_path / "extracted_audio"
+    rng = np.random.default_rng(0)
+    for participant_id, timestamp in SEGMENTS:
+        os.makedirs(extracted_dir / participant_id, exist_ok=True)
+        with wave.open(str(extracted_dir / participant_id / f"{participant_id}_{timestamp}.wav"), "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes((rng.standard_normal(32000) * 3000).astype(np.int16).tobytes())
+    pd.DataFrame(
+        {"filename": [p for p, _ in SEGMENTS], "timestamp": [t for _, t in SEGMENTS]}
+    ).to_csv(tmp_path / "utterances.csv", index=False)
+
+    biasing_dir = tmp_path / "biasing_lists"
+    os.makedirs(biasing_dir)
+    with open(biasing_dir / "biasing_list_adler01a.txt", "w") as f:
+        f.write("the\nand\nof\n")
+
+    monkeypatch.setattr(transcribe_segments.whisper, "load_model", lambda *args, **kwargs: tiny_model)
+    return tmp_path, str(extracted_dir), str(biasing_dir)
+
+
+def transcribe(tmp_path, extracted_dir, name, **kwargs):
+    csv_file = str(tmp_path / name)
+    pd.read_csv(tmp_path / "utterances.csv").to_csv(csv_file, index=False)
+    transcribe_segments.transcribe_audio_segments(extracted_dir, csv_file, beam_size=3, **kwargs)
+    return pd.read_csv(csv_file, dtype=str, keep_default_na=False)
+
+
+def test_per_speaker_lists_in_mixed_batches(corpus):
+    tmp_path, extracted_dir, biasing_dir = corpus
+    options = dict(use_jargon=True, biasing_list_path=biasing_dir, dict_coeff=2.0)
+    batched = transcribe(tmp_path, extracted_dir, "batched.csv", decode_batch_size=4, **options)
+    single = transcribe(tmp_path, extracted_dir, "single.csv", decode_batch_size=1, **options)
+
+    assert not os.path.exists(tmp_path / "batched_journal.jsonl")
+    assert batched["whisper_transcription"].tolist() == single["whisper_transcription"].tolist()
+
+
+def test_jargon_without_biasing_list(corpus):
+    tmp_path, extracted_dir, _ = corpus
+    jargon = transcribe(tmp_path, extracted_dir, "jargon.csv", use_jargon=True, decode_batch_size=2)
+    plain = transcribe(tmp_path, extracted_dir, "plain.csv", decode_batch_size=2)
+
+    assert jargon["whisper_transcription"].tolist() == plain["whisper_transcription"].tolist()
+
+
+class HeldFile:
+    # a trace file whose writes only reach the disk when it is closed
+    def __init__(self, file):
+        self.file = file
+        self.held = []
+
+    def write(self, text):
+        self.held.append(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.file.write("".join(self.held))
+        self.file.close()
+
+
+def test_worker_flushes_trace_before_reporting_done(corpus, tiny_model, monkeypatch):
+    _, extracted_dir, _ = corpus
+    init = TraceWriter.__init__
+
+    def held_init(writer, path):
+        init(writer, path)
+        writer.file = HeldFile(writer.file)
+
+    monkeypatch.setattr(TraceWriter, "__init__", held_init)
+
+    trace_file = os.path.join(extracted_dir, "logs", "decode_trace_worker0.jsonl")
+    batches = [
+        [(os.path.join(extracted_dir, p, f"{p}_{t}.wav"), f"{p}_{t}.wav", p, t, i) for i, (p, t) in enumerate(SEGMENTS[k:k + 2])]
+        for k in (0, 2)
+    ]
+    settings = dict(
+        use_jargon=False, biasing_list_path=None, per_speaker_lists=False, beam_size=3, dict_coeff=0.0,
+        trace="summary", trace_file=trace_file, feature_cache=None, feature_cache_size=0, fp16=False,
+        beam_stop_bound=None, beam_prune_margin=None,
+    )
+    results = queue.Queue()
+    transcription_worker(
+        0, tiny_model, batches, extracted_dir, settings, ["whisper_transcription"], 2, 1, torch.get_num_threads(), None, results
+    )
+
+    messages = [results.get_nowait() for _ in range(results.qsize())]
+    assert messages[-1] == (0, 0, None)
+    # by the time the worker reports done, its trace is closed and on disk
+    with open(trace_file) as f:
+        starts = [record for record in map(json.loads, f) if record["event"] == "start"]
+    assert len(starts) == len(batches)
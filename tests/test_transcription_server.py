@@ -0,0 +1,78 @@
+import base64
+import json
+import threading
+import urllib.request
+
+import numpy as np
+import pytest
+
+import whisper
+from transcription_server import TranscriptionServer, make_server
+
+
+@pytest.fixture
+def server(tiny_model):
+    # a long batching window, so that concurrent requests always share a decode
+    transcriber = TranscriptionServer({"tiny": tiny_model}, window=1.0)
+    decoded_groups = []
+    decode = transcriber.batcher.decode
+
+    def recording_decode(model_name, beam_size, dict_coeff, group):
+        decoded_groups.append(len(group))
+        return decode(model_name, beam_size, dict_coeff, group)
+
+    transcriber.batcher.decode = recording_decode
+    server = make_server(transcriber, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, decoded_groups
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, request):
+    url = f"http://127.0.0.1:{server.server_address[1]}/transcribe"
+    body = json.dumps(request).encode("utf-8")
+    with urllib.request.urlopen(urllib.request.Request(url, body)) as response:
+        return json.loads(response.read())
+
+
+def noise_pcm(seed, seconds):
+    samples = np.random.default_rng(seed).standard_normal(16000 * seconds) * 3000
+    return samples.astype(np.int16)
+
+
+def test_concurrent_requests_are_batched(server, tiny_model):
+    server, decoded_groups = server
+    pcms = [noise_pcm(0, 2), noise_pcm(1, 3)]
+    responses = [None] * len(pcms)
+
+    def request(i):
+        pcm = base64.b64encode(pcms[i].tobytes()).decode("ascii")
+        responses[i] = post(server, {"pcm": pcm, "beam_size": 3})
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(len(pcms))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert decoded_groups == [2]
+    options = whisper.DecodingOptions(task="transcribe", language="en", beam_size=3, fp16=False)
+    for pcm, response in zip(pcms, responses):
+        audio = whisper.pad_or_trim(pcm.astype(np.float32) / 32768.0)
+        expected = whisper.decode(tiny_model, whisper.log_mel_spectrogram(audio), options)
+        assert response["text"] == expected.text.strip()
+
+
+def test_failed_request_does_not_fail_its_batch(server, mels):
+    server, decoded_groups = server
+    batcher = server.transcriber.batcher
+    good = batcher.submit("tiny", mels[0], None, 1.0, 3)
+    bad = batcher.submit("tiny", mels[1], "missing_biasing_list.txt", 1.0, 3)
+
+    assert good.result().text is not None
+    with pytest.raises(FileNotFoundError):
+        bad.result()
+    # the batch failed, then each request was decoded on its own
+    assert decoded_groups == [2, 1, 1]
@@ -1,106 +1,399 @@
 import sys
 import os
+import json
 import pandas as pd
 import argparse
 import glob
+import queue
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from tqdm import tqdm
 import torch
 import whisper  # Import the whole module
 
 from whisper.tokenizer import Tokenizer
+from whisper.utils import close_trace_writers
+from extract_audio_segments import MelStore
 
-def transcribe_audio_segments(extracted_dir, csv_file, model_name="base", use_jargon=False, biasing_list_path=None, beam_size=10, dict_coeff=0.0, batch_size=10, output_column="whisper_transcription"):
+def speaker_biasing_list(biasing_dir, participant_id):
     """
-    Transcribe extracted audio segments using Whisper and add results to CSV
+    Return the biasing list of a speaker written by create_biasing_list.py, or None if there is none
+    """
+    path = os.path.join(biasing_dir, f"biasing_list_{participant_id}.txt")
+    return path if os.path.exists(path) else None
+
+def journal_path(csv_file):
+    """
+    Return the path of the append-only journal of transcriptions not yet merged into the CSV
+    """
+    return os.path.splitext(csv_file)[0] + "_journal.jsonl"
+
+def replay_journal(df, rows, path):
+    """
+    Copy the transcriptions recorded in a journal into the DataFrame, and return how many there were
+    """
+    if not os.path.exists(path):
+        return 0
+    
+    replayed = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            key = (entry["filename"], entry["timestamp"])
+            if key not in rows:
+                continue
+            if entry["column"] not in df.columns:
+                df[entry["column"]] = None
+            df.loc[df.index[rows[key]], entry["column"]] = entry["text"]
+            replayed += 1
+    return replayed
+
+def save_csv(df, csv_file):
+    """
+    Save the DataFrame to the CSV, replacing the old file only once the new one is complete
+    """
+    tmp_file = csv_file + ".tmp"
+    df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, csv_file)
+
+def load_mel(audio_file, n_mels):
+    """
+    Load an audio segment and compute its log-Mel spectrogram, padded or trimmed to 30 seconds
+    """
+    audio = whisper.load_audio(audio_file)
+    audio = whisper.pad_or_trim(audio)
+    return whisper.log_mel_spectrogram(audio, n_mels=n_mels)
+
+def prefetch_mels(batches, load, depth=4, threads=2):
+    """
+    Yield the stacked mels of each batch of segments, loaded with load by a thread pool up to
+    depth batches ahead, so that ffmpeg and the spectrograms overlap with decoding
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        queued = deque()
+        for batch in batches:
+            queued.append([executor.submit(load, segment) for segment in batch])
+            if len(queued) > depth:
+                yield torch.stack([future.result() for future in queued.popleft()])
+        while queued:
+            yield torch.stack([future.result() for future in queued.popleft()])
+
+def find_segments(extracted_dir, n_mels):
+    """
+    Return the extracted segments as (segment, name) pairs, from WAV files or a mel store
+    """
+    if MelStore.is_store(extracted_dir):
+        mel_store = MelStore(extracted_dir)
+        if mel_store.n_mels != n_mels:
+            raise ValueError(f"{extracted_dir} has {mel_store.n_mels} mel filters, but the model expects {n_mels}")
+        return [(key, f"{key[0]}_{key[1]}") for key in mel_store.keys()]
+    audio_files = glob.glob(os.path.join(extracted_dir, "**/*.wav"), recursive=True)
+    return [(audio_file, audio_file) for audio_file in audio_files]
+
+def segment_loader(extracted_dir, n_mels):
+    """
+    Return the function loading the mel spectrogram of a segment returned by find_segments
+    """
+    if MelStore.is_store(extracted_dir):
+        mel_store = MelStore(extracted_dir)
+        return lambda key: torch.from_numpy(mel_store.load(key))
+    return lambda audio_file: load_mel(audio_file, n_mels)
+
+def make_batches(pending, decode_batch_size, per_speaker_lists):
+    """
+    Split the pending segments of each speaker into batches of up to decode_batch_size;
+    with one biasing list per speaker, a batch may mix speakers
+    """
+    if per_speaker_lists:
+        segments = [segment for segments in pending.values() for segment in segments]
+        return [segments[i:i + decode_batch_size] for i in range(0, len(segments), decode_batch_size)]
+    return [
+        segments[i:i + decode_batch_size]
+        for segments in pending.values()
+        for i in range(0, len(segments), decode_batch_size)
+    ]
+
+def shard_by_participant(pending, workers):
+    """
+    Split the pending segments between workers, keeping each speaker's segments together and
+    giving the largest speakers first to the least loaded worker
+    """
+    shards = [{} for _ in range(workers)]
+    loads = [0] * workers
+    for participant_id, segments in sorted(pending.items(), key=lambda item: -len(item[1])):
+        worker = loads.index(min(loads))
+        shards[worker][participant_id] = segments
+        loads[worker] += len(segments)
+    return [shard for shard in shards if shard]
+
+def decoding_options(batch, settings):
+    """
+    Return the DecodingOptions of a batch of pending segments
+    """
+    # Pick the biasing list of each segment's speaker
+    dict_path = settings["biasing_list_path"] if settings["use_jargon"] else None
+    if settings["per_speaker_lists"]:
+        dict_path = [speaker_biasing_list(settings["biasing_list_path"], participant_id) for _, _, participant_id, _, _ in batch]
+    
+    return whisper.DecodingOptions(
+        task="transcribe",
+        language="en",
+        beam_size=settings["beam_size"],
+        dict_path=dict_path,
+        dict_coeff=settings["dict_coeff"],
+        transcription_file=[name for _, name, _, _, _ in batch],
+        trace=settings["trace"],
+        trace_file=settings["trace_file"],
+        feature_cache_dir=settings["feature_cache"],
+        feature_cache_size=settings["feature_cache_size"],
+        fp16=settings["fp16"],
+        beam_stop_bound=settings["beam_stop_bound"],
+        beam_prune_margin=settings["beam_prune_margin"]
+    )
+
+def decode_batches(model, batches, load, settings, prefetch, loader_threads):
+    """
+    Yield each batch of pending segments with its decoding results
+    """
+    mel_batches = prefetch_mels([[segment for segment, _, _, _, _ in batch] for batch in batches], load, prefetch, loader_threads)
+    for batch, mel in zip(batches, mel_batches):
+        # The audio was loaded ahead; the encoder runs once for the whole batch
+        mel = mel.to(model.device)
+        yield batch, whisper.decode(model, mel, decoding_options(batch, settings))
+
+def batch_records(batch, results, output_columns):
+    """
+    Return the (row_idx, participant_id, timestamp, column, text) transcriptions of a batch;
+    a sweep returns the results of the batch once per coefficient
+    """
+    records = []
+    for i, result in enumerate(results):
+        _, _, participant_id, timestamp, row_idx = batch[i % len(batch)]
+        records.append((row_idx, participant_id, timestamp, output_columns[i // len(batch)], result.text.strip()))
+    return records
+
+def transcription_worker(worker, model, batches, extracted_dir, settings, output_columns, prefetch, loader_threads, threads, cores, results):
+    """
+    Decode a shard of batches in a worker process, sending the records of each batch to results
+    as (worker, n_segments, records), then (worker, 0, None) once done, or (worker, None, traceback)
+    """
+    torch.set_num_threads(threads)
+    if cores:
+        os.sched_setaffinity(0, cores)
+    try:
+        load = segment_loader(extracted_dir, model.dims.n_mels)
+        for batch, decoded in decode_batches(model, batches, load, settings, prefetch, loader_threads):
+            results.put((worker, len(batch), batch_records(batch, decoded, output_columns)))
+    except Exception:
+        done = (worker, None, traceback.format_exc())
+    else:
+        done = (worker, 0, None)
+    # Flush the trace before reporting; it is otherwise written at exit, after the main process may have moved on
+    close_trace_writers()
+    results.put(done)
+
+def run_workers(model, shards, extracted_dir, settings, output_columns, prefetch, loader_threads, threads):
+    """
+    Decode each shard of batches in its own process, and yield (n_segments, records) as batches
+    finish, so that only this process writes results
+    """
+    # The workers receive the loaded model through shared memory instead of loading their own;
+    # they are spawned rather than forked, since OpenMP does not survive a fork once used.
+    # The file_system strategy keeps large models from running out of file descriptors
+    torch.multiprocessing.set_sharing_strategy("file_system")
+    context = torch.multiprocessing.get_context("spawn")
+    results = context.Queue()
+    
+    # Pin each worker to its own cores when there are enough of them
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    processes = []
+    for worker, batches in enumerate(shards):
+        worker_cores = set(cores[worker * threads:(worker + 1) * threads]) if len(cores) >= len(shards) * threads else None
+        worker_settings = dict(settings, trace_file=settings["trace_file"].replace(".jsonl", f"_worker{worker}.jsonl"))
+        process = context.Process(
+            target=transcription_worker,
+            args=(worker, model, batches, extracted_dir, worker_settings, output_columns, prefetch, loader_threads, threads, worker_cores, results),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+    
+    running = len(processes)
+    try:
+        while running:
+            try:
+                worker, n_segments, records = results.get(timeout=5)
+            except queue.Empty:
+                for worker, process in enumerate(processes):
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError(f"Worker {worker} exited with code {process.exitcode}")
+                continue
+            if n_segments is None:
+                raise RuntimeError(f"Worker {worker} failed:\n{records}")
+            if records is None:
+                running -= 1
+                continue
+            yield n_segments, records
+    finally:
+        # Workers which reported done are left to exit on their own; the others are stopped
+        for process in processes:
+            process.join(timeout=30 if running == 0 else 0)
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def transcribe_audio_segments(extracted_dir, csv_file, model_name="base", use_jargon=False, biasing_list_path=None, beam_size=10, dict_coeff=0.0, batch_size=10, output_column="whisper_transcription", trace="off", decode_batch_size=1, prefetch=4, loader_threads=2, feature_cache=None, feature_cache_gb=4.0, quantize=False, workers=1, threads_per_worker=None, beam_stop_bound=None, beam_prune_margin=None):
+    """
+    Transcribe extracted audio segments using Whisper and add results to CSV.
+    Up to decode_batch_size segments are decoded together, taken speaker by speaker.
+    If biasing_list_path is a directory, each speaker uses its own
+    biasing_list_<filename>.txt from it, and speakers without one are not biased.
+    Results are appended to a journal next to the CSV as they come, and merged into
+    the CSV once at the end; an interrupted run resumes from the journal.
+    Audio is loaded by loader_threads threads, up to prefetch batches ahead of the model.
+    extracted_dir may also be a mel store written by extract_audio_segments.py --mel-store.
+    With feature_cache, the encoder output of each segment is kept in that directory, up to
+    feature_cache_gb, so later runs on the same audio and model skip the encoder.
+    dict_coeff may be a list of coefficients to sweep: the audio is encoded once and decoded
+    with each coefficient, into one column per coefficient named <output_column>_<coeff>.
+    With quantize, the model runs on CPU in fp32 with int8 Linear layers.
+    With workers > 1, the speakers are split between that many CPU processes sharing the
+    loaded model, each running threads_per_worker threads (by default, the cores divided
+    between the workers), and this process writes their results.
+    beam_stop_bound and beam_prune_margin end the beam search of a segment early, once the
+    best finished transcription leads every live beam by beam_stop_bound, and drop candidates
+    more than beam_prune_margin below the best; see DecodingOptions.
     """ 
     # Add device selection
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = "cuda" if torch.cuda.is_available() and not quantize and workers == 1 else "cpu"
     print(f"Using device: {device}")
     
     # Load the original CSV
     df = pd.read_csv(csv_file)
     
     # Add a column for Whisper transcriptions if it doesn't exist
-    if output_column not in df.columns:
-        df[output_column] = None
+    # With a sweep over several coefficients, each one gets its own column
+    sweep = isinstance(dict_coeff, (list, tuple)) and len(dict_coeff) > 1 and use_jargon
+    if sweep:
+        output_columns = [f"{output_column}_{coeff:g}" for coeff in dict_coeff]
+    else:
+        if isinstance(dict_coeff, (list, tuple)):
+            dict_coeff = dict_coeff[0]
+        output_columns = [output_column]
+    for column in output_columns:
+        if column not in df.columns:
+            df[column] = None
     
     # Load the Whisper model
     print(f"Loading Whisper model: {model_name}")
-    model = whisper.load_model(model_name, device=device)
+    model = whisper.load_model(model_name, device=device, quantize=quantize)
     
-    # Find all extracted audio files
-    all_segments = glob.glob(os.path.join(extracted_dir, "**/*.wav"), recursive=True)
+    # All decodes of this run append to one trace file
+    trace_file = os.path.join(extracted_dir, "logs", f"decode_trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+    
+    # Find all extracted segments, as WAV files or in a mel store
+    all_segments = find_segments(extracted_dir, model.dims.n_mels)
     print(f"Found {len(all_segments)} audio segments")
     
-    # Count how many need processing
-    to_process = 0
-    for audio_file in all_segments:
-        filename = os.path.basename(audio_file)
-        parts = filename.split('_')
-        participant_id = parts[0]
-        timestamp = '_'.join(parts[1:3]).replace('.wav', '')
-        
-        row_idx = df[(df['filename'] == participant_id) & 
-                    (df['timestamp'] == timestamp)].index
-        
-        if len(row_idx) > 0 and pd.isna(df.loc[row_idx[0], output_column]):
-            to_process += 1
+    # Index the rows by (filename, timestamp) once, instead of scanning the table for each segment
+    rows = df.groupby(['filename', 'timestamp'], sort=False).indices
     
-    print(f"Found {to_process} audio segments that need transcription")
+    # Resume from the transcriptions of an interrupted run
+    journal_file = journal_path(csv_file)
+    replayed = replay_journal(df, rows, journal_file)
+    if replayed:
+        print(f"Resumed {replayed} transcriptions from {journal_file}")
+    untranscribed = df[output_columns].isna().any(axis=1).to_numpy()
+    needs_transcription = {key for key, positions in rows.items() if untranscribed[positions[0]]}
     
-    # Process each audio file
-    processed = 0
-    for audio_file in tqdm(all_segments, desc="Transcribing"):
+    # Find the segments that need processing, grouped by speaker
+    pending = {}
+    for segment, name in all_segments:
         # Extract participant ID and timestamp from filename
-        filename = os.path.basename(audio_file)
+        filename = os.path.basename(name)
         parts = filename.split('_')
         participant_id = parts[0]
         timestamp = '_'.join(parts[1:3]).replace('.wav', '')
         
         # Find the corresponding row in the DataFrame
-        row_idx = df[(df['filename'] == participant_id) & 
-                     (df['timestamp'] == timestamp)].index
-        
-        if len(row_idx) == 0:
+        key = (participant_id, timestamp)
+        if key not in rows:
             print(f"Warning: No matching row found for {filename}")
             continue
         
         # Skip if already transcribed
-        if len(row_idx) > 0 and not pd.isna(df.loc[row_idx[0], output_column]):
+        if key not in needs_transcription:
             continue
         
-        # Load and process audio
-        audio = whisper.load_audio(audio_file)
-        audio = whisper.pad_or_trim(audio)
-        mel = whisper.log_mel_spectrogram(audio, n_mels=model.dims.n_mels).to(model.device)
-        
-        # Set decoding options
-        options = whisper.DecodingOptions(
-            task="transcribe",
-            language="en",
-            beam_size=beam_size,
-            dict_path=biasing_list_path if use_jargon else None,
-            dict_coeff=dict_coeff if use_jargon else 0.0,
-            transcription_file=audio_file
+        row_idx = df.index[rows[key]]
+        pending.setdefault(participant_id, []).append((segment, name, participant_id, timestamp, row_idx))
+    
+    # With one biasing list per speaker, a batch may mix speakers; otherwise each
+    # speaker's segments are split into batches of up to decode_batch_size
+    per_speaker_lists = use_jargon and biasing_list_path is not None and os.path.isdir(biasing_list_path)
+    to_process = sum(len(segments) for segments in pending.values())
+    print(f"Found {to_process} audio segments that need transcription")
+    
+    settings = {
+        "use_jargon": use_jargon,
+        "biasing_list_path": biasing_list_path,
+        "per_speaker_lists": per_speaker_lists,
+        "beam_size": beam_size,
+        "dict_coeff": list(dict_coeff) if sweep else dict_coeff if use_jargon else 0.0,
+        "trace": trace,
+        "trace_file": trace_file,
+        "feature_cache": feature_cache,
+        "feature_cache_size": int(feature_cache_gb * 1024**3),
+        "fp16": not quantize,
+        "beam_stop_bound": beam_stop_bound,
+        "beam_prune_margin": beam_prune_margin,
+    }
+    if workers > 1:
+        # Each worker takes whole speakers, so a speaker's segments still batch together
+        shards = [make_batches(shard, decode_batch_size, per_speaker_lists) for shard in shard_by_participant(pending, workers)]
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // len(shards))
+        print(f"Transcribing with {len(shards)} workers of {threads_per_worker} threads")
+        decoded = run_workers(model, shards, extracted_dir, settings, output_columns, prefetch, loader_threads, threads_per_worker)
+    else:
+        batches = make_batches(pending, decode_batch_size, per_speaker_lists)
+        load = segment_loader(extracted_dir, model.dims.n_mels)
+        decoded = (
+            (len(batch), batch_records(batch, results, output_columns))
+            for batch, results in decode_batches(model, batches, load, settings, prefetch, loader_threads)
         )
-        
-        # Transcribe the audio
-        result = whisper.decode(model, mel, options)
-        transcription = result.text.strip()
-        
-        # Update the DataFrame
-        df.loc[row_idx, output_column] = transcription
+    
+    # Process each batch of audio files
+    processed = 0
+    progress = tqdm(total=to_process, desc="Transcribing")
+    journal = open(journal_file, "a", encoding="utf-8")
+    for n_segments, records in decoded:
+        # Update the DataFrame, and record the results in the journal
+        for row_idx, participant_id, timestamp, column, transcription in records:
+            df.loc[row_idx, column] = transcription
+            journal.write(json.dumps({"filename": participant_id, "timestamp": timestamp, "column": column, "text": transcription}) + "\n")
+        journal.flush()
         
         # Update progress counter
-        processed += 1
+        previous = processed
+        processed += n_segments
+        progress.update(n_segments)
         
-        # Save more frequently and show progress
-        if processed % batch_size == 0:
-            df.to_csv(csv_file, index=False)
+        # Make the journal durable and show progress
+        if processed // batch_size > previous // batch_size:
+            os.fsync(journal.fileno())
             print(f"Progress: {processed}/{to_process} ({processed/to_process*100:.1f}%)")
+    progress.close()
+    journal.close()
     
-    # Final save
-    df.to_csv(csv_file, index=False)
+    # Final save, merging the journal into the CSV
+    save_csv(df, csv_file)
+    os.remove(journal_file)
     print(f"Transcription complete. Processed {processed} files.")
 
 def main():
@@ -112,15 +405,37 @@ def main():
     parser.add_argument("--use-jargon", action="store_true", 
                         help="Use jargon decoding with biasing list")
     parser.add_argument("--biasing-list", "-b", 
-                        help="Path to the biasing list file")
+                        help="Path to the biasing list file, or a directory of per-speaker biasing_list_<filename>.txt files")
     parser.add_argument("--beam-size", type=int, default=10, 
                         help="Beam size for decoding")
-    parser.add_argument("--dict-coeff", type=float, default=0.0, 
-                        help="Dictionary coefficient for biasing")
+    parser.add_argument("--beam-stop-bound", type=float,
+                        help="Stop the beam search of a segment once its best finished transcription, length-normalized, leads every live beam by this much; small bounds such as 0 can change results")
+    parser.add_argument("--beam-prune-margin", type=float,
+                        help="Drop beam candidates whose log probability is more than this below the best candidate of their segment; tight margins can change results")
+    parser.add_argument("--dict-coeff", type=float, nargs="+", default=[0.0], 
+                        help="Dictionary coefficient for biasing; several values are swept in one pass, into one column each")
     parser.add_argument("--batch-size", type=int, default=10,
-                        help="How often to save progress to CSV")
+                        help="How often to sync the results journal to disk and show progress")
+    parser.add_argument("--decode-batch-size", type=int, default=1,
+                        help="Number of segments of the same speaker to decode together")
     parser.add_argument("--output-column", "-o", default="whisper_transcription",
                         help="Column name for storing transcriptions")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Number of batches of audio to load ahead of the model")
+    parser.add_argument("--loader-threads", type=int, default=2,
+                        help="Number of threads loading audio")
+    parser.add_argument("--feature-cache",
+                        help="Directory caching the encoder output of each segment, so that sweeps over the same audio skip the encoder")
+    parser.add_argument("--feature-cache-gb", type=float, default=4.0,
+                        help="Size limit of the feature cache in GB")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Run on CPU with the Linear layers quantized to int8")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of CPU processes transcribing in parallel, each taking whole speakers")
+    parser.add_argument("--threads-per-worker", type=int,
+                        help="Number of torch threads of each worker (default: the cores divided between the workers)")
+    parser.add_argument("--trace", choices=["off", "summary", "full"], default="off",
+                        help="Beam search trace, written to one JSON Lines file per run under <extracted_dir>/logs")
     
     args = parser.parse_args()
     transcribe_audio_segments(
@@ -132,7 +447,18 @@ def main():
         args.beam_size, 
         args.dict_coeff, 
         args.batch_size,
-        args.output_column
+        args.output_column,
+        args.trace,
+        args.decode_batch_size,
+        args.prefetch,
+        args.loader_threads,
+        args.feature_cache,
+        args.feature_cache_gb,
+        args.quantize,
+        args.workers,
+        args.threads_per_worker,
+        args.beam_stop_bound,
+        args.beam_prune_margin
     )
 
 if __name__ == "__main__":
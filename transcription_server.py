@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import base64
+import socket
+import socketserver
+import argparse
+import threading
+import queue
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+import whisper
+
+from whisper.decoding import load_dict_trie
+from whisper.tokenizer import get_tokenizer
+from transcribe_segments import load_mel, speaker_biasing_list
+
+class MicroBatcher:
+    """
+    Decode the requests of concurrent clients together: the first queued request waits up to
+    window seconds for others, and those with the same model, beam size and dictionary
+    coefficient go through one DecodingTask.run, with up to max_batch segments each
+    """
+
+    def __init__(self, models, window=0.02, max_batch=16):
+        self.models = models
+        self.window = window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, model_name, mel, dict_path, dict_coeff, beam_size):
+        """
+        Queue one mel spectrogram for decoding, and return a Future of its DecodingResult
+        """
+        future = Future()
+        self.requests.put(((model_name, beam_size, dict_coeff), mel, dict_path, future))
+        return future
+
+    def collect(self):
+        # block for the first request, then take whatever arrives within the window
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            groups = {}
+            for request in self.collect():
+                groups.setdefault(request[0], []).append(request)
+            for (model_name, beam_size, dict_coeff), group in groups.items():
+                try:
+                    results = self.decode(model_name, beam_size, dict_coeff, group)
+                except Exception as e:
+                    if len(group) == 1:
+                        group[0][3].set_exception(e)
+                        continue
+                    # decode the requests one by one, so that one bad request fails only itself
+                    for request in group:
+                        try:
+                            result, = self.decode(model_name, beam_size, dict_coeff, [request])
+                        except Exception as error:
+                            request[3].set_exception(error)
+                        else:
+                            request[3].set_result(result)
+                    continue
+                for (_, _, _, future), result in zip(group, results):
+                    future.set_result(result)
+
+    def decode(self, model_name, beam_size, dict_coeff, group):
+        model = self.models[model_name]
+        dict_paths = [dict_path for _, _, dict_path, _ in group]
+        mel = torch.stack([mel for _, mel, _, _ in group]).to(model.device)
+        options = whisper.DecodingOptions(
+            task="transcribe",
+            language="en",
+            beam_size=beam_size,
+            dict_path=dict_paths if any(path is not None for path in dict_paths) else None,
+            dict_coeff=dict_coeff,
+            fp16=model.device.type == "cuda",
+        )
+        return whisper.decode(model, mel, options)
+
+def load_models(model_names, device=None, quantize=False):
+    """
+    Load each Whisper model once, keyed by its name
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() and not quantize else "cpu"
+    models = {}
+    for model_name in model_names:
+        print(f"Loading Whisper model: {model_name}")
+        models[model_name] = whisper.load_model(model_name, device=device, quantize=quantize)
+    return models
+
+class TranscriptionServer:
+    """
+    Hold loaded models, by name, and the compiled biasing lists of biasing_dir, and transcribe
+    requests through a MicroBatcher; requests that do not name a model use the first one
+    """
+
+    def __init__(self, models, biasing_dir=None, window=0.02, max_batch=16):
+        self.models = models
+        self.default_model = next(iter(models))
+        self.biasing_dir = biasing_dir
+        self.batcher = MicroBatcher(self.models, window, max_batch)
+
+    def biasing_list(self, model, list_id):
+        """
+        Return the compiled trie of a biasing list id, the <id> of a biasing_list_<id>.txt in
+        biasing_dir; loaded tries are reused until their word list changes
+        """
+        if list_id is None:
+            return None
+        path = speaker_biasing_list(self.biasing_dir, list_id) if self.biasing_dir else None
+        if path is None:
+            raise ValueError(f"unknown biasing list: {list_id}")
+        tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages, language="en", task="transcribe")
+        return load_dict_trie(path, tokenizer)
+
+    def transcribe(self, request):
+        """
+        Transcribe one request, a dict with an "audio" path or base64 "pcm" (16 kHz mono 16-bit),
+        and optionally "model", "biasing_list", "dict_coeff" and "beam_size"
+        """
+        model_name = request.get("model", self.default_model)
+        if model_name not in self.models:
+            raise ValueError(f"model {model_name} is not loaded; loaded models = {list(self.models)}")
+        model = self.models[model_name]
+
+        if "audio" in request:
+            mel = load_mel(request["audio"], model.dims.n_mels)
+        elif "pcm" in request:
+            pcm = np.frombuffer(base64.b64decode(request["pcm"]), np.int16)
+            audio = whisper.pad_or_trim(pcm.astype(np.float32) / 32768.0)
+            mel = whisper.log_mel_spectrogram(audio, n_mels=model.dims.n_mels)
+        else:
+            raise ValueError("a request needs either audio or pcm")
+
+        trie = self.biasing_list(model, request.get("biasing_list"))
+        dict_coeff = float(request.get("dict_coeff", 0.0)) if trie is not None else 0.0
+        beam_size = int(request.get("beam_size", 10))
+        result = self.batcher.submit(model_name, mel, trie, dict_coeff, beam_size).result()
+        return {
+            "text": result.text.strip(),
+            "avg_logprob": result.avg_logprob,
+            "no_speech_prob": result.no_speech_prob,
+        }
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /transcribe with a JSON request, GET /health for the loaded models
+    """
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.reply(404, {"error": f"unknown path: {self.path}"})
+        self.reply(200, {"models": list(self.server.transcriber.models)})
+
+    def do_POST(self):
+        if self.path != "/transcribe":
+            return self.reply(404, {"error": f"unknown path: {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            response = self.server.transcriber.transcribe(request)
+        except (ValueError, KeyError, OSError, RuntimeError) as e:
+            # RuntimeError covers audio that ffmpeg fails to decode
+            return self.reply(400, {"error": str(e)})
+        except Exception as e:
+            return self.reply(500, {"error": str(e)})
+        self.reply(200, response)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def make_server(transcriber, host="127.0.0.1", port=8765, unix_socket=None):
+    """
+    Return an HTTP server of a TranscriptionServer, bound to host:port or to a Unix socket
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.transcriber = transcriber
+    return server
+
+def serve(transcriber, host="127.0.0.1", port=8765, unix_socket=None):
+    """
+    Serve a TranscriptionServer over HTTP, on host:port or on a Unix socket, until interrupted
+    """
+    server = make_server(transcriber, host, port, unix_socket)
+    print(f"Serving on {unix_socket}" if unix_socket else f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Whisper transcription with loaded models and biasing lists")
+    parser.add_argument("--model", "-m", nargs="+", default=["base"],
+                        help="Whisper models to load; the first one is used by requests that do not name one")
+    parser.add_argument("--biasing-dir", "-b",
+                        help="Directory of biasing_list_<id>.txt files, selected by the biasing_list of a request")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port to listen on")
+    parser.add_argument("--socket",
+                        help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--batch-window-ms", type=float, default=20,
+                        help="How long the first request of a batch waits for others to decode with")
+    parser.add_argument("--max-batch", type=int, default=16,
+                        help="Maximum number of segments decoded together")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Run on CPU with the Linear layers quantized to int8")
+
+    args = parser.parse_args()
+    transcriber = TranscriptionServer(
+        load_models(args.model, quantize=args.quantize),
+        args.biasing_dir,
+        window=args.batch_window_ms / 1000,
+        max_batch=args.max_batch
+    )
+    serve(transcriber, args.host, args.port, args.socket)
+
+if __name__ == "__main__":
+    main()
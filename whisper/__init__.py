@@ -1,9 +1,10 @@
 import hashlib
 import io
+import json
 import os
 import urllib
 import warnings
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 from tqdm import tqdm
@@ -53,6 +54,48 @@ _ALIGNMENT_HEADS = {
 }
 
 
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _verify_checksum(path: str, expected_sha256: str) -> bool:
+    # `<path>.sha256` records the checksum of a verified file along with its size and
+    # mtime, so that an unchanged file is not hashed again on every load
+    sidecar = path + ".sha256"
+    stat = os.stat(path)
+    try:
+        with open(sidecar) as f:
+            verified = json.load(f)
+        if verified == {
+            "sha256": expected_sha256,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }:
+            return True
+    except (OSError, ValueError):
+        pass
+
+    if _sha256(path) != expected_sha256:
+        return False
+    try:
+        with open(sidecar, "w") as f:
+            json.dump(
+                {
+                    "sha256": expected_sha256,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                },
+                f,
+            )
+    except OSError:
+        pass  # a read-only cache is still usable, only slower to verify
+    return True
+
+
 def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
@@ -63,10 +106,8 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        with open(download_target, "rb") as f:
-            model_bytes = f.read()
-        if hashlib.sha256(model_bytes).hexdigest() == expected_sha256:
-            return model_bytes if in_memory else download_target
+        if _verify_checksum(download_target, expected_sha256):
+            return open(download_target, "rb").read() if in_memory else download_target
         else:
             warnings.warn(
                 f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file"
@@ -88,13 +129,46 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    model_bytes = open(download_target, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != expected_sha256:
+    if not _verify_checksum(download_target, expected_sha256):
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
         )
 
-    return model_bytes if in_memory else download_target
+    return open(download_target, "rb").read() if in_memory else download_target
+
+
+def _load_checkpoint(checkpoint_file: Union[bytes, str], device, **kwargs) -> dict:
+    if isinstance(checkpoint_file, bytes):
+        with io.BytesIO(checkpoint_file) as fp:
+            return torch.load(fp, map_location=device, **kwargs)
+    try:
+        # the tensors are read from the page cache as they are copied into the model, so the
+        # checkpoint is never held in memory twice, and concurrent workers share its pages
+        return torch.load(checkpoint_file, map_location=device, mmap=True, **kwargs)
+    except (TypeError, RuntimeError):
+        # torch < 2.1, or a checkpoint in the legacy (non-zip) serialization format
+        return torch.load(checkpoint_file, map_location=device, **kwargs)
+
+
+def _quantized_cache(name: str, download_root: str) -> Tuple[str, str]:
+    # where the quantized weights of a model are cached, and the checkpoint they come from
+    if name in _MODELS:
+        return os.path.join(download_root, f"{name}.int8.pt"), _MODELS[name]
+    path = os.path.abspath(name)
+    return os.path.splitext(path)[0] + ".int8.pt", f"{path}:{os.stat(path).st_mtime_ns}"
+
+
+def _load_quantized(quantized_file: str, source: str) -> Optional[Whisper]:
+    # the cache is only used if it was quantized from the same checkpoint
+    if not os.path.isfile(quantized_file):
+        return None
+    checkpoint = _load_checkpoint(quantized_file, "cpu", weights_only=False)
+    if checkpoint.get("source") != source:
+        return None
+
+    model = Whisper(ModelDimensions(**checkpoint["dims"])).quantize_int8()
+    model.load_state_dict(checkpoint["model_state_dict"])
+    return model
 
 
 def available_models() -> List[str]:
@@ -107,6 +181,7 @@ def load_model(
     device: Optional[Union[str, torch.device]] = None,
     download_root: str = None,
     in_memory: bool = False,
+    quantize: bool = False,
 ) -> Whisper:
     """
     Load a Whisper ASR model
@@ -122,6 +197,9 @@ def load_model(
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    quantize: bool
+        whether to quantize the Linear layers to int8, for inference on CPU only; the quantized
+        weights are cached next to the checkpoint, as `<name>.int8.pt`
 
     Returns
     -------
@@ -135,6 +213,17 @@ def load_model(
         default = os.path.join(os.path.expanduser("~"), ".cache")
         download_root = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
 
+    if quantize and torch.device(device).type != "cpu":
+        raise ValueError("int8 quantization is only supported on CPU")
+    if quantize and (name in _MODELS or os.path.isfile(name)):
+        quantized_file, source = _quantized_cache(name, download_root)
+        model = _load_quantized(quantized_file, source)
+        if model is not None:
+            if name in _MODELS:
+                model.set_alignment_heads(_ALIGNMENT_HEADS[name])
+            model.name = (name if name in _MODELS else os.path.abspath(name)) + ":int8"
+            return model
+
     if name in _MODELS:
         checkpoint_file = _download(_MODELS[name], download_root, in_memory)
         alignment_heads = _ALIGNMENT_HEADS[name]
@@ -146,10 +235,7 @@ def load_model(
             f"Model {name} not found; available models = {available_models()}"
         )
 
-    with (
-        io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
-    ) as fp:
-        checkpoint = torch.load(fp, map_location=device)
+    checkpoint = _load_checkpoint(checkpoint_file, device)
     del checkpoint_file
 
     dims = ModelDimensions(**checkpoint["dims"])
@@ -158,5 +244,19 @@ def load_model(
 
     if alignment_heads is not None:
         model.set_alignment_heads(alignment_heads)
+    # identifies the weights, e.g. for the audio feature cache of `DecodingOptions`
+    model.name = name if name in _MODELS else os.path.abspath(name)
+
+    if quantize:
+        model = model.to(device).quantize_int8()
+        model.name += ":int8"
+        torch.save(
+            {
+                "source": source,
+                "dims": checkpoint["dims"],
+                "model_state_dict": model.state_dict(),
+            },
+            quantized_file,
+        )
 
     return model.to(device)
@@ -1,4 +1,5 @@
 import os
+import wave
 from functools import lru_cache
 from subprocess import CalledProcessError, run
 from typing import Optional, Union
@@ -39,6 +40,11 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     A NumPy array containing the audio waveform, in float32 dtype.
     """
 
+    # WAVs which are already mono 16-bit PCM at the target rate are read directly
+    audio = _load_pcm16_wav(file, sr)
+    if audio is not None:
+        return audio
+
     # This launches a subprocess to decode audio while down-mixing
     # and resampling as necessary.  Requires the ffmpeg CLI in PATH.
     # fmt: off
@@ -62,6 +68,27 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
 
 
+def _load_pcm16_wav(file: str, sr: int) -> Optional[np.ndarray]:
+    """
+    Read a mono 16-bit PCM WAV file sampled at `sr` without launching ffmpeg,
+    or return None if the file is in any other format
+    """
+    try:
+        with wave.open(file, "rb") as f:
+            if (
+                f.getnchannels() != 1
+                or f.getsampwidth() != 2
+                or f.getframerate() != sr
+                or f.getcomptype() != "NONE"
+            ):
+                return None
+            frames = f.readframes(f.getnframes())
+    except (wave.Error, EOFError, OSError):
+        return None
+
+    return np.frombuffer(frames, "<i2").astype(np.float32) / 32768.0
+
+
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
     """
     Pad or trim the audio array to N_SAMPLES, as expected by the encoder.
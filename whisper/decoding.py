@@ -1,8 +1,14 @@
 import csv
+import hashlib
+import json
+import os
+import struct
 import sys
+import warnings
 from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from pathlib import Path
-from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
 
 sys.path.append(str(Path(__file__).resolve().absolute().parents[2]))
 
@@ -14,13 +20,13 @@ from torch.distributions import Categorical
 
 from .audio import CHUNK_LENGTH
 from .tokenizer import Tokenizer, get_tokenizer
-from .utils import compression_ratio
+from .utils import compression_ratio, get_trace_writer
 
 if TYPE_CHECKING:
+    from tiktoken import Encoding
+
     from .model import Whisper
 
-import logging
-import os
 from datetime import datetime
 
 
@@ -98,6 +104,509 @@ class DictTrie:
 
                 q.append(next_seq)
 
+    def compile(
+        self, encoding_name: Optional[str] = None, add_space: Optional[bool] = None
+    ) -> "CompiledDictTrie":
+        """
+        Convert the tuple-keyed trie into its array-backed form; call after `build_backoff`.
+        `encoding_name` and `add_space` record how the words were tokenized.
+        """
+        # number the nodes breadth-first, with the children of each node sorted by token
+        order = [()]
+        node_ids = {(): 0}
+        for seq in order:
+            for next_seq in sorted(self.next_at_sequence[seq], key=lambda s: s[-1]):
+                node_ids[next_seq] = len(order)
+                order.append(next_seq)
+
+        child_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        output_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        child_tokens, child_nodes, output_lengths = [], [], []
+        for node, seq in enumerate(order):
+            children = sorted(self.next_at_sequence[seq], key=lambda s: s[-1])
+            child_tokens.extend(next_seq[-1] for next_seq in children)
+            child_nodes.extend(node_ids[next_seq] for next_seq in children)
+            child_offsets[node + 1] = len(child_tokens)
+            output_lengths.extend(self.end_at_sequence.get(seq, []))
+            output_offsets[node + 1] = len(output_lengths)
+
+        return CompiledDictTrie(
+            child_offsets=child_offsets,
+            child_tokens=np.array(child_tokens, dtype=np.int64),
+            child_nodes=np.array(child_nodes, dtype=np.int64),
+            fail=np.array(
+                [node_ids[self.backoff_at_sequence.get(seq, ())] for seq in order],
+                dtype=np.int64,
+            ),
+            depth=np.array([len(seq) for seq in order], dtype=np.int64),
+            output_offsets=output_offsets,
+            output_lengths=np.array(output_lengths, dtype=np.int64),
+            encoding_name=encoding_name,
+            add_space=add_space,
+        )
+
+
+class CompiledDictTrie:
+    """
+    Array-backed form of a `DictTrie`, where every token sequence is a dense integer node id
+    and the root is node 0.
+
+    The children of node `n` are stored in CSR layout: their tokens, sorted, are
+    `child_tokens[child_offsets[n] : child_offsets[n + 1]]` and their ids are the matching slice
+    of `child_nodes`. `fail` holds the backoff node, `depth` the number of tokens matched at the
+    node, and `output_lengths[output_offsets[n] : output_offsets[n + 1]]` the word lengths
+    recorded in `end_at_sequence`, which include those of the backoff sequences.
+
+    Matching follows the beam search it replaces: a token extends the match if the node has a
+    child for it, and otherwise resets the match to the root, without backing off. For batched
+    matching, `output_weights` holds, for each node, the weight of the k-th most recent matched
+    logprob in the score of the words ending there; transitions are looked up in the sorted
+    edge keys of `tensors`, so no table grows with the square of the number of words.
+
+    `save` writes all the arrays to a single file, which `load` memory-maps: a magic string,
+    the format version and the length of a JSON header describing the tokenizer encoding and
+    the arrays, then the arrays themselves at 64-byte aligned offsets.
+    """
+
+    MAGIC = b"DICTTRIE"
+    # larger than any token id, so the edge keys of a node sort before those of the next node
+    EDGE_STRIDE = 1 << 32
+    VERSION = 3
+    ARRAYS = (
+        "child_offsets",
+        "child_tokens",
+        "child_nodes",
+        "fail",
+        "depth",
+        "output_offsets",
+        "output_lengths",
+        "output_weights",
+    )
+
+    def __init__(
+        self,
+        child_offsets: np.ndarray,
+        child_tokens: np.ndarray,
+        child_nodes: np.ndarray,
+        fail: np.ndarray,
+        depth: np.ndarray,
+        output_offsets: np.ndarray,
+        output_lengths: np.ndarray,
+        output_weights: Optional[np.ndarray] = None,
+        encoding_name: Optional[str] = None,
+        add_space: Optional[bool] = None,
+    ):
+        self.child_offsets = child_offsets
+        self.child_tokens = child_tokens
+        self.child_nodes = child_nodes
+        self.fail = fail
+        self.depth = depth
+        self.output_offsets = output_offsets
+        self.output_lengths = output_lengths
+        self.max_depth = max(int(depth.max()), 1)
+        self.encoding_name = encoding_name
+        self.add_space = add_space
+
+        self.output_weights = output_weights
+        if output_weights is None:
+            self._build_tables()
+
+        self._tensors: Dict[torch.device, Dict[str, Tensor]] = {}
+
+    def _build_tables(self):
+        # weight of the k-th most recent matched logprob in the score of the words ending at a node
+        self.output_weights = np.zeros((self.n_nodes, self.max_depth), dtype=np.float32)
+        for node in range(self.n_nodes):
+            for end_length in self.outputs(node):
+                self.output_weights[node, : min(int(end_length), self.max_depth)] += 1
+
+    @staticmethod
+    def _data_start(header_length: int) -> int:
+        return -(-(len(CompiledDictTrie.MAGIC) + 8 + header_length) // 64) * 64
+
+    def save(self, path: str):
+        arrays = {name: np.ascontiguousarray(getattr(self, name)) for name in self.ARRAYS}
+        specs, offset = {}, 0
+        for name, array in arrays.items():
+            specs[name] = dict(dtype=array.dtype.str, shape=array.shape, offset=offset)
+            offset += -(-array.nbytes // 64) * 64
+
+        header = json.dumps(
+            dict(encoding=self.encoding_name, add_space=self.add_space, arrays=specs)
+        ).encode("utf-8")
+        data_start = self._data_start(len(header))
+        with open(path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack("<II", self.VERSION, len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + specs[name]["offset"])
+                f.write(array.tobytes())
+            f.truncate(data_start + offset)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "CompiledDictTrie":
+        """Read a trie written by `save`, memory-mapping its arrays read-only if `mmap` is set"""
+        with open(path, "rb") as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a compiled dictionary trie")
+            version, header_length = struct.unpack("<II", f.read(8))
+            if version != cls.VERSION:
+                raise ValueError(
+                    f"{path} has format version {version}, expected {cls.VERSION}"
+                )
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+        data_start = cls._data_start(header_length)
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+            offset = data_start + spec["offset"]
+            if mmap and np.prod(shape) > 0:
+                arrays[name] = np.memmap(
+                    path, dtype=dtype, mode="r", offset=offset, shape=shape
+                )
+            else:
+                count = int(np.prod(shape))
+                array = np.fromfile(path, dtype=dtype, count=count, offset=offset)
+                arrays[name] = array.reshape(shape)
+
+        return cls(
+            **arrays, encoding_name=header["encoding"], add_space=header["add_space"]
+        )
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.depth)
+
+    def child(self, node: int, token: int) -> int:
+        """Return the child of `node` reached by `token`, or -1 if there is none"""
+        start, end = self.child_offsets[node], self.child_offsets[node + 1]
+        i = start + np.searchsorted(self.child_tokens[start:end], token)
+        if i < end and self.child_tokens[i] == token:
+            return int(self.child_nodes[i])
+        return -1
+
+    def has_children(self, node: int) -> bool:
+        return self.child_offsets[node + 1] > self.child_offsets[node]
+
+    def outputs(self, node: int) -> np.ndarray:
+        return self.output_lengths[
+            self.output_offsets[node] : self.output_offsets[node + 1]
+        ]
+
+    def walk(self, sequence: Sequence[int]) -> int:
+        """Return the node matching `sequence` from the root, or -1 if it is not in the trie"""
+        node = 0
+        for token in sequence:
+            node = self.child(node, token)
+            if node < 0:
+                break
+        return node
+
+    def step(self, node: int, token: int) -> int:
+        """Advance from `node` by `token`, back to the root when `node` has no child for it"""
+        return max(self.child(node, token), 0)
+
+    def tensors(self, device: torch.device) -> Dict[str, Tensor]:
+        """The tables used for batched matching, copied once to `device`"""
+        device = torch.device(device)
+        if device not in self._tensors:
+            # the edges sorted by parent node then token, as keys parent * EDGE_STRIDE + token,
+            # and a sentinel above every key so a lookup always lands inside the array
+            parents = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.child_offsets))
+            edge_keys = np.append(parents * self.EDGE_STRIDE + self.child_tokens, np.iinfo(np.int64).max)
+            edge_nodes = np.append(self.child_nodes, 0).astype(np.int64)
+            with warnings.catch_warnings():
+                # the arrays may be read-only memory maps, which are never written through
+                warnings.filterwarnings("ignore", message=".*not writable.*")
+                self._tensors[device] = {
+                    "edge_keys": torch.from_numpy(edge_keys).to(device),
+                    "edge_nodes": torch.from_numpy(edge_nodes).to(device),
+                    "roots": torch.zeros(self.n_nodes, dtype=torch.int64, device=device),
+                    "depth": torch.from_numpy(self.depth).to(device),
+                    "output_weights": torch.from_numpy(self.output_weights).to(device),
+                    "has_children": torch.from_numpy(
+                        self.child_offsets[1:] > self.child_offsets[:-1]
+                    ).to(device),
+                }
+        return self._tensors[device]
+
+
+class DictTrieCursor:
+    """
+    Match state of every beam in a `CompiledDictTrie`: the node reached by the end of each
+    sequence, and the logprobs of the tokens matched to get there, most recent first and
+    zero-padded to the depth of the trie.
+
+    Given a list of tries, the batch is split into as many equal parts, each matched against
+    its own trie; the edges of the tries are then stacked into one sorted array of keys, so all
+    rows still advance at once, at a cost which grows with the number of edges.
+    """
+
+    def __init__(
+        self,
+        trie: Union[CompiledDictTrie, Sequence[CompiledDictTrie]],
+        n_batch: int,
+        device: torch.device,
+    ):
+        tries = [trie] if isinstance(trie, CompiledDictTrie) else list(trie)
+        if n_batch % len(tries) != 0:
+            raise ValueError(f"{n_batch} rows cannot be split between {len(tries)} tries")
+        # a trie given for several parts of the batch is stacked only once
+        self.tries = list({id(part_trie): part_trie for part_trie in tries}.values())
+
+        tables, roots = self._stack_tables(self.tries, device)
+        root_of = dict(zip(map(id, self.tries), roots.tolist()))
+        roots = torch.tensor([root_of[id(part_trie)] for part_trie in tries], device=device)
+        self.edge_keys = tables["edge_keys"]
+        self.edge_nodes = tables["edge_nodes"]
+        self.roots = tables["roots"]
+        self.depth = tables["depth"]
+        self.output_weights = tables["output_weights"]
+        self.has_children = tables["has_children"]
+
+        self.nodes = roots.repeat_interleave(n_batch // len(tries))
+        self.logprobs = torch.zeros(
+            n_batch, self.output_weights.shape[-1], device=device
+        )
+        self.candidate_nodes: Optional[Tensor] = None
+        self.candidate_logprobs: Optional[Tensor] = None
+
+    def advance(self, tokens: Tensor, logprobs: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Advance the match of every sequence by each of its candidate tokens at once
+
+        Parameters
+        ----------
+        tokens : Tensor, shape = (n_batch, n_candidates)
+            the candidate next tokens of each sequence
+
+        logprobs : Tensor, shape = (n_batch, n_candidates)
+            the log probabilities of the candidate tokens
+
+        Returns
+        -------
+        perma_scores : Tensor, shape = (n_batch, n_candidates)
+            the summed logprobs of the dictionary words completed by each candidate
+
+        temp_scores : Tensor, shape = (n_batch, n_candidates)
+            the summed logprobs of the partial match, if it can still be extended
+        """
+        n_candidates = tokens.shape[-1]
+        # the child of each node for each token, or the root of its trie if there is none
+        keys = self.nodes[:, None] * CompiledDictTrie.EDGE_STRIDE + tokens
+        edges = torch.searchsorted(self.edge_keys, keys)
+        nodes = torch.where(
+            self.edge_keys[edges] == keys, self.edge_nodes[edges], self.roots[self.nodes][:, None]
+        )
+
+        # shift the new logprob in, and keep as many as the depth of the new node
+        shifted = torch.cat(
+            [
+                logprobs[..., None],
+                self.logprobs[:, None, :-1].expand(-1, n_candidates, -1),
+            ],
+            dim=-1,
+        )
+        positions = torch.arange(shifted.shape[-1], device=shifted.device)
+        matched = positions < self.depth[nodes][..., None]
+        candidate_logprobs = torch.where(matched, shifted, torch.zeros_like(shifted))
+
+        weights = self.output_weights[nodes]
+        perma_scores = torch.where(
+            weights > 0, weights * candidate_logprobs, torch.zeros_like(weights)
+        ).sum(dim=-1)
+        temp_scores = torch.where(
+            self.has_children[nodes],
+            candidate_logprobs.sum(dim=-1),
+            torch.zeros_like(perma_scores),
+        )
+
+        self.candidate_nodes, self.candidate_logprobs = nodes, candidate_logprobs
+        return perma_scores, temp_scores
+
+    @staticmethod
+    def _stack_tables(
+        tries: List[CompiledDictTrie], device: torch.device
+    ) -> Tuple[Dict[str, Tensor], Tensor]:
+        """
+        Number the nodes of all tries one after the other, and concatenate their edges with the
+        node ids shifted accordingly, so the edge keys stay sorted. Returns the stacked tables
+        and the node id of each root.
+        """
+        tables = [trie.tensors(device) for trie in tries]
+        n_nodes = torch.tensor([trie.n_nodes for trie in tries], device=device)
+        roots = n_nodes.cumsum(0) - n_nodes
+        if len(tries) == 1:
+            return tables[0], roots
+
+        max_depth = max(trie.max_depth for trie in tries)
+        edge_keys, edge_nodes, output_weights = [], [], []
+        for table, root in zip(tables, roots):
+            # leave out the sentinel of each trie, and add one at the end
+            edge_keys.append(table["edge_keys"][:-1] + root * CompiledDictTrie.EDGE_STRIDE)
+            edge_nodes.append(table["edge_nodes"][:-1] + root)
+            weights = table["output_weights"]
+            output_weights.append(F.pad(weights, (0, max_depth - weights.shape[-1])))
+        edge_keys.append(tables[0]["edge_keys"][-1:])
+        edge_nodes.append(tables[0]["edge_nodes"][-1:])
+
+        stacked = {
+            "edge_keys": torch.cat(edge_keys),
+            "edge_nodes": torch.cat(edge_nodes),
+            "roots": roots.repeat_interleave(n_nodes),
+            "output_weights": torch.cat(output_weights),
+        }
+        for name in ("depth", "has_children"):
+            stacked[name] = torch.cat([table[name] for table in tables])
+        return stacked, roots
+
+    def update(self, selected: Tensor):
+        """Keep the match state of the selected candidates, as indices into the flattened candidates"""
+        self.nodes = self.candidate_nodes.flatten()[selected]
+        self.logprobs = self.candidate_logprobs.flatten(0, 1)[selected]
+
+
+def build_dict_trie(
+    path: str, tokenizer: Tokenizer, add_space: bool = True
+) -> CompiledDictTrie:
+    """
+    Build the compiled trie of the words in the first column of a TSV file; with `add_space`,
+    each word is tokenized with a leading space, as it would be in the middle of a sentence
+    """
+    return _build_dict_trie(path, tokenizer.encoding, add_space)
+
+
+def _build_dict_trie(path: str, encoding: "Encoding", add_space: bool):
+    dictionary = DictTrie()
+    with open(path, newline="") as f_csv:
+        reader = csv.reader(f_csv, delimiter="\t")
+        for row in reader:
+            if not row:
+                continue
+            # word is the first column of the row
+            text = " " + row[0].strip() if add_space else row[0]
+            dictionary.add_sequence(encoding.encode(text))
+    dictionary.build_backoff()
+    return dictionary.compile(encoding.name, add_space)
+
+
+def compiled_dict_trie_path(path: str) -> str:
+    """Where a word list's compiled trie is saved, next to the list itself"""
+    return os.path.splitext(path)[0] + ".trie"
+
+
+@lru_cache(maxsize=32)
+def _load_dict_trie(
+    path: str, mtime_ns: int, encoding: "Encoding", add_space: bool
+) -> CompiledDictTrie:
+    if path.endswith(".trie"):
+        trie = CompiledDictTrie.load(path)
+        if trie.encoding_name != encoding.name:
+            raise ValueError(
+                f"{path} was built with the {trie.encoding_name} encoding, "
+                f"but the model uses {encoding.name}"
+            )
+        return trie
+
+    # reuse the trie saved next to the word list, if it is up to date and tokenized the same way;
+    # one saved in an older format is rebuilt
+    compiled_path = compiled_dict_trie_path(path)
+    if (
+        os.path.isfile(compiled_path)
+        and os.stat(compiled_path).st_mtime_ns >= mtime_ns
+    ):
+        try:
+            trie = CompiledDictTrie.load(compiled_path)
+        except ValueError:
+            trie = None
+        if trie is not None and (trie.encoding_name, trie.add_space) == (
+            encoding.name,
+            add_space,
+        ):
+            return trie
+
+    return _build_dict_trie(path, encoding, add_space)
+
+
+def load_dict_trie(
+    path: str, tokenizer: Tokenizer, add_space: bool = True
+) -> CompiledDictTrie:
+    """
+    Load the compiled trie of a TSV word list, or of a `.trie` file written by
+    `CompiledDictTrie.save`, reusing the one already loaded in this process for the same file,
+    modification time and tokenizer encoding
+    """
+    path = os.path.abspath(path)
+    mtime_ns = os.stat(path).st_mtime_ns
+    return _load_dict_trie(path, mtime_ns, tokenizer.encoding, add_space)
+
+
+class AudioFeatureCache:
+    """
+    Encoder outputs saved on disk, one `.npy` file per audio in the dtype of the encoder,
+    named after the hash of the mel spectrogram, the model name and the precision. Files are
+    memory-mapped when read, and the least recently used ones are deleted once the cache
+    takes more than `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(mel: Tensor, model_name: str, fp16: bool) -> str:
+        # the mel shape holds the number of mel filters
+        digest = hashlib.sha256(f"{model_name}:{tuple(mel.shape)}:{fp16}".encode())
+        digest.update(mel.detach().cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self._path(key)
+        try:
+            features = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass  # evicted by another process since, or a read-only cache
+        return features
+
+    def put(self, key: str, features: np.ndarray):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, features)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # evicted by another process
+            total -= size
+
+
+@lru_cache(maxsize=None)
+def get_audio_feature_cache(directory: str, max_bytes: int) -> AudioFeatureCache:
+    return AudioFeatureCache(directory, max_bytes)
 
 
 @torch.no_grad()
@@ -181,6 +690,13 @@ class DecodingOptions:
     # to select which to return among the beams or best-of-N samples
     length_penalty: Optional[float] = None
 
+    # early exit of beam search, off when None: stop an audio once its best finished sequence,
+    # length-normalized, leads every live beam ending at the next step by beam_stop_bound,
+    # and drop the candidates scoring more than beam_prune_margin below the best of their audio;
+    # these are heuristics, so small bounds such as 0 and tight margins can change the results
+    beam_stop_bound: Optional[float] = None
+    beam_prune_margin: Optional[float] = None
+
     # text or tokens to feed as the prompt or the prefix; for more info:
     # https://github.com/openai/whisper/discussions/117#discussioncomment-3727051
     prompt: Optional[Union[str, List[int]]] = None  # for the previous context
@@ -198,19 +714,27 @@ class DecodingOptions:
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
 
-    # Boost dictionary details
-    dict_path: Optional[str] = None
-    dict_coeff: float = 0.0
+    # Boost dictionary details; the path of a TSV word list, or an already-built trie
+    dict_path: Optional[Union[str, "CompiledDictTrie", List]] = None  # or a list with one per audio
+    dict_coeff: Union[float, List[float]] = 0.0  # or a list, to decode every audio once per coefficient
 
     # Ban dictionary details
-    ban_dict_path: Optional[str] = None
+    ban_dict_path: Optional[Union[str, "CompiledDictTrie", List]] = None  # or a list with one per audio
     ban_dict_coeff: float = 0.0
 
     # Ngram details
     ngram_path: Optional[str] = None
     ngram_coeff: float = 0.0
 
-    transcription_file: Optional[str] = None  # Instead of audio_file
+    transcription_file: Optional[Union[str, List[str]]] = None  # Instead of audio_file; one per audio when batched
+
+    # beam search trace: "off", "summary" (dictionary and finished sequences) or "full" (every candidate)
+    trace: str = "off"
+    trace_file: str = "decode_trace.jsonl"  # JSON Lines file shared by all decodes of a run
+
+    # directory caching the encoder output of each audio across decodes, e.g. for coefficient sweeps
+    feature_cache_dir: Optional[str] = None
+    feature_cache_size: int = 4 * 1024**3  # in bytes; the least recently used are deleted beyond it
 
 
 @dataclass(frozen=True)
@@ -269,9 +793,8 @@ class PyTorchInference(Inference):
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
-            for module in self.kv_modules:
-                # update the key/value cache to contain the selected sequences
-                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+            # update the key/value buffers in place to contain the selected sequences
+            self.kv_cache.rearrange(source_indices)
 
 
 class SequenceRanker:
@@ -285,6 +808,18 @@ class SequenceRanker:
         raise NotImplementedError
 
 
+def length_normalized(
+    logprob: float, length: int, length_penalty: Optional[float]
+) -> float:
+    """The score of a sequence of `length` sampled tokens, as ranked among the others"""
+    if length_penalty is None:
+        penalty = length
+    else:
+        # from the Google NMT paper
+        penalty = ((5 + length) / 6) ** length_penalty
+    return logprob / penalty
+
+
 class MaximumLikelihoodRanker(SequenceRanker):
     """
     Select the sample with the highest log probabilities, penalized using either
@@ -296,15 +831,10 @@ class MaximumLikelihoodRanker(SequenceRanker):
 
     def rank(self, tokens: List[List[Tensor]], sum_logprobs: List[List[float]]):
         def scores(logprobs, lengths):
-            result = []
-            for logprob, length in zip(logprobs, lengths):
-                if self.length_penalty is None:
-                    penalty = length
-                else:
-                    # from the Google NMT paper
-                    penalty = ((5 + length) / 6) ** self.length_penalty
-                result.append(logprob / penalty)
-            return result
+            return [
+                length_normalized(logprob, length, self.length_penalty)
+                for logprob, length in zip(logprobs, lengths)
+            ]
 
         # get the sequence with the highest score
         lengths = [[len(t) for t in s] for s in tokens]
@@ -320,8 +850,6 @@ class TokenDecoder:
         tokens: Tensor,
         logits: Tensor,
         sum_logprobs: Tensor,
-        dict_logprobs: List[List[float]],
-        ban_dict_logprobs: List[List[float]],
     ) -> Tuple[Tensor, bool]:
         """Specify how to select the next token, based on the current trace and logits
 
@@ -382,8 +910,6 @@ class GreedyDecoder(TokenDecoder):
         tokens: Tensor,
         logits: Tensor,
         sum_logprobs: Tensor,
-        dict_logprobs: List[List[float]],
-        ban_dict_logprobs: List[List[float]],
     ) -> Tuple[Tensor, bool]:
         if self.temperature == 0:
             next_tokens = logits.argmax(dim=-1)
@@ -414,52 +940,33 @@ class BeamSearchDecoder(TokenDecoder):
         inference: Inference,
         patience: Optional[float] = None,
         tokenizer: Optional[Tokenizer] = None,
-        dict_path: str = None,
-        dict_coeff: float = 0.0,
-        ban_dict_path: str = None,
+        dict_path: Union[str, CompiledDictTrie, List] = None,
+        dict_coeff: Union[float, List[float]] = 0.0,
+        ban_dict_path: Union[str, CompiledDictTrie, List] = None,
         ban_dict_coeff: float = 0.0,
         ngram_path: str = None,
         ngram_coeff: float = 0.0,
-        transcription_file: str = None,
+        transcription_file: Union[str, List[str]] = None,
+        trace: str = "off",
+        trace_file: str = "decode_trace.jsonl",
+        sample_begin: int = 0,
+        length_penalty: Optional[float] = None,
+        stop_bound: Optional[float] = None,
+        prune_margin: Optional[float] = None,
     ):
-        # Create logs directory structure based on transcription file path
-        if transcription_file:
-            # Extract directory and base filename
-            transcription_dir = os.path.dirname(transcription_file)
-            base_filename = os.path.basename(transcription_file).replace('.wav', '')
-            
-            # Create a logs directory in the same location as the audio file
-            logs_dir = os.path.join(transcription_dir, 'logs')
-            os.makedirs(logs_dir, exist_ok=True)
-            
-            # Create log filename with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.log_file = os.path.join(logs_dir, f"{base_filename}_coeff_{dict_coeff}_{timestamp}.log")
-        else:
-            # Default fallback if no transcription file is provided
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.log_file = f"log_dict_coeff_{dict_coeff}_{timestamp}.txt"
-        
-        # Set up logging to the file
-        logger = logging.getLogger(__name__)
-        if logger.handlers:
-            for handler in logger.handlers:
-                logger.removeHandler(handler)
-                
-        # Set up file handler for this transcription
-        file_handler = logging.FileHandler(self.log_file)
-        file_handler.setFormatter(logging.Formatter('%(message)s'))
-        logger.addHandler(file_handler)
-        logger.setLevel(logging.DEBUG)
-        self.logger = logger
-        
-        # Log the start of decoding for this file
-        if transcription_file:
-            self.logger.debug(f"Starting decoding for file: {transcription_file}")
-            self.logger.debug(f"Dictionary coefficient: {dict_coeff}")
-            self.logger.debug(f"Beam size: {beam_size}")
-            self.logger.debug(f"Time: {timestamp}")
-            self.logger.debug("-" * 50)
+        # the trace is written for "summary" and "full"; "off" does no formatting nor file I/O
+        self.trace = trace
+        self.trace_writer = get_trace_writer(trace_file) if trace != "off" else None
+        self.transcription_file = transcription_file
+        self.n_steps = 0
+        if self.trace != "off":
+            # Log the start of decoding for this file
+            self._trace(
+                "start",
+                dict_coeff=dict_coeff,
+                beam_size=beam_size,
+                time=datetime.now().isoformat(timespec="seconds"),
+            )
 
         # Initialize class attributes
         self.beam_size = beam_size
@@ -468,82 +975,156 @@ class BeamSearchDecoder(TokenDecoder):
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
         self.finished_sequences = None
+        # early exit: the audio whose beams are dead, and which decode along the others until all stop
+        self.sample_begin = sample_begin
+        self.length_penalty = length_penalty
+        self.stop_bound = stop_bound
+        self.prune_margin = prune_margin
+        self.stopped: Set[int] = set()
+        self.boost_cursor: Optional[DictTrieCursor] = None
+        self.ban_cursor: Optional[DictTrieCursor] = None
         self.tokenizer = tokenizer
         assert (
             self.max_candidates > 0
         ), f"Invalid beam size ({beam_size}) or patience ({patience})"
-        self.boost_dictionary = DictTrie()
-        self.boost = True if dict_path else False
+        self.boost = bool(dict_path)
         self.boost_coeff = dict_coeff
+        self.boost_scale: Union[float, Tensor] = dict_coeff  # per row, for a sweep
+        self.boost_tries: List[CompiledDictTrie] = []
         if self.boost:
-            self.read_data_for_boost_dictionary(dict_path)
+            # add a space in front of each word, as it would be tokenized in the middle of a sentence
+            self.boost_tries = self._load_dictionaries(dict_path, add_space=True)
 
-        self.ban_dictionary = DictTrie()
-        self.ban = True if ban_dict_path else False
+        self.ban = bool(ban_dict_path)
         self.ban_coeff = ban_dict_coeff
+        self.ban_tries: List[CompiledDictTrie] = []
         if self.ban:
-            self.read_data_for_ban_dictionary(ban_dict_path)
+            self.ban_tries = self._load_dictionaries(ban_dict_path, add_space=False)
 
         self.ngram = KenNgramLM(ngram_path) if ngram_path else None
         self.ngram_coeff = ngram_coeff
 
-        self.logger.debug("Boost dictionary built")
-        # Assuming value is a list of tuples, extract the integers
-        for key, value in self.boost_dictionary.next_at_sequence.items():
-            # Decode the key
-            decoded_key = self.tokenizer.decode(list(key)) if self.tokenizer else str(key)
-            
-            # Flatten the value if it's a list of lists
-            if isinstance(value, list) and all(isinstance(sublist, list) for sublist in value):
-                flat_value = [item for sublist in value for item in sublist]
-            else:
-                flat_value = value
-            
-            # Ensure flat_value is a list of integers
-            if isinstance(flat_value, list):
-                # If flat_value contains tuples, extract integers
-                flat_value = [item for sublist in flat_value for item in sublist] if all(isinstance(sublist, tuple) for sublist in flat_value) else flat_value
-                decoded_value = '| '.join(self.tokenizer.decode([item]) for item in flat_value)
-            else:
-                decoded_value = self.tokenizer.decode([flat_value])
-            
-            # Log the decoded key and decoded value
-            self.logger.debug(f"Key: {key}:{decoded_key} -> Values: {value}:{decoded_value}")
-
-    def read_data_for_boost_dictionary(self, dict_path: str):
-        self.logger.debug(f"Reading dictionary with tokenizer: language={self.tokenizer.language}")
-        self.logger.debug(f"Tokenizer name: {self.tokenizer.encoding.name}")
-        # Create a tokenizer with the exact same configuration as used in beam search
-        with open(dict_path, newline="") as f_csv:
-            reader = csv.reader(f_csv, delimiter="\t")
-            for row in reader:
-                word = row[0].strip() # word is the first column of the row
-                tokens = self.tokenizer.encode(" " + word) # add a space in front of the word to avoid tokenizing the word as a single token => this works!
-                self.boost_dictionary.add_sequence(tokens)
-                self.logger.debug(f"Added to dictionary: '{word}' → {tokens} → {self.tokenizer.decode(tokens)}")
-                print("--------------------------------")
-        self.boost_dictionary.build_backoff()
-
-    def read_data_for_ban_dictionary(self, ban_dict_path: str):
-        with open(ban_dict_path, newline="") as f_csv:
-            reader = csv.reader(f_csv, delimiter="\t")
-            for row in reader:
-                tokens = self.tokenizer.encode(row[0])
-
-                self.ban_dictionary.add_sequence(tokens)
-                # print(row[0], tokens)
-        self.ban_dictionary.build_backoff()
+        if self.trace == "full":
+            for audio, trie in enumerate(self.boost_tries):
+                self._trace_dictionary(trie, audio if len(self.boost_tries) > 1 else None)
+
+    def _trace(self, event: str, **fields):
+        # batched decodes name one file per audio; records of a single audio name only its own
+        file = self.transcription_file
+        if isinstance(file, (list, tuple)) and "audio" in fields:
+            # a sweep over dict_coeff values decodes each audio once per coefficient
+            file = file[fields["audio"] % len(file)]
+        self.trace_writer.write({"file": file, "event": event, **fields})
+
+    def _trace_dictionary(self, trie: CompiledDictTrie, audio: Optional[int] = None):
+        # one record per prefix in the boost dictionary, with the tokens that can follow it;
+        # nodes are numbered breadth-first, so every parent is visited before its children
+        fields = {} if audio is None else {"audio": audio}
+        sequences = {0: []}
+        for node in range(trie.n_nodes):
+            start, end = trie.child_offsets[node], trie.child_offsets[node + 1]
+            next_tokens = trie.child_tokens[start:end].tolist()
+            for token, child in zip(next_tokens, trie.child_nodes[start:end].tolist()):
+                sequences[child] = sequences[node] + [token]
+            self._trace(
+                "dictionary_prefix",
+                tokens=sequences[node],
+                text=self.tokenizer.decode(sequences[node]),
+                next_tokens=next_tokens,
+                next_texts=[self.tokenizer.decode([token]) for token in next_tokens],
+                **fields,
+            )
+
+    def _load_dictionaries(
+        self, dict_path: Union[str, CompiledDictTrie, List], add_space: bool
+    ) -> List[CompiledDictTrie]:
+        # one dictionary shared by all audio, or one per audio in the batch
+        if isinstance(dict_path, (list, tuple)):
+            return [
+                self._load_dictionary(path, add_space, audio)
+                for audio, path in enumerate(dict_path)
+            ]
+        return [self._load_dictionary(dict_path, add_space)]
+
+    def _load_dictionary(
+        self,
+        dict_path: Optional[Union[str, CompiledDictTrie]],
+        add_space: bool,
+        audio: Optional[int] = None,
+    ) -> CompiledDictTrie:
+        if isinstance(dict_path, CompiledDictTrie):
+            trie = dict_path
+        elif dict_path is None:
+            # audio without a dictionary in a batch where others have one
+            trie = DictTrie().compile(self.tokenizer.encoding.name, add_space)
+        else:
+            trie = load_dict_trie(dict_path, self.tokenizer, add_space)
+        if self.trace != "off":
+            fields = {} if audio is None else {"audio": audio}
+            self._trace(
+                "dictionary",
+                path=dict_path if isinstance(dict_path, str) else None,
+                n_nodes=trie.n_nodes,
+                encoding=self.tokenizer.encoding.name,
+                **fields,
+            )
+        return trie
 
     def reset(self):
         self.finished_sequences = None
+        self.stopped = set()
+        self.n_steps = 0
+        self.boost_cursor = None
+        self.ban_cursor = None
+
+    def _trace_candidates(
+        self,
+        prefixes: List[Tuple[int, ...]],
+        sum_logprobs: Tensor,
+        top_logprobs: Tensor,
+        top_tokens: Tensor,
+        scores: Tensor,
+    ):
+        # one record per beam, listing its expanded candidates and their dictionary matches
+        for idx, prefix in enumerate(prefixes):
+            candidates = []
+            for candidate_idx, (logprob, token) in enumerate(
+                zip(top_logprobs[idx].tolist(), top_tokens[idx].tolist())
+            ):
+                candidate = {
+                    "token": token,
+                    "text": self.tokenizer.decode([token]),
+                    "logprob": logprob,
+                    "score": scores[idx, candidate_idx].item(),
+                }
+                if self.boost_cursor is not None:
+                    node = self.boost_cursor.candidate_nodes[idx, candidate_idx]
+                    depth = self.boost_cursor.depth[node].item()
+                    if depth > 0:
+                        matched = self.boost_cursor.candidate_logprobs[
+                            idx, candidate_idx, :depth
+                        ]
+                        candidate["matched_word"] = self.tokenizer.decode(
+                            list(prefix[len(prefix) - depth + 1 :]) + [token]
+                        )
+                        candidate["matched_logprobs"] = matched.flip(0).tolist()
+                candidates.append(candidate)
+
+            self._trace(
+                "beam",
+                step=self.n_steps,
+                audio=idx // self.beam_size,
+                beam=idx % self.beam_size,
+                prefix=self.tokenizer.decode(list(prefix[3:])),
+                sum_logprob=sum_logprobs[idx].item(),
+                candidates=candidates,
+            )
 
     def update(
         self,
         tokens: Tensor,
         logits: Tensor,
         sum_logprobs: Tensor,
-        dict_logprobs: List[List[float]],
-        ban_dict_logprobs: List[List[float]],
     ) -> Tuple[Tensor, bool]:
 
         if tokens.shape[0] % self.beam_size != 0:
@@ -552,221 +1133,151 @@ class BeamSearchDecoder(TokenDecoder):
         n_audio = tokens.shape[0] // self.beam_size
         if self.finished_sequences is None:  # for the first update
             self.finished_sequences = [{} for _ in range(n_audio)]
+            # a sweep over dict_coeff values repeats the batch once per coefficient
+            n_sweep = 1
+            if isinstance(self.boost_coeff, (list, tuple)):
+                n_sweep = len(self.boost_coeff)
+                coeffs = torch.tensor(self.boost_coeff, device=logits.device)
+                self.boost_scale = coeffs.repeat_interleave(tokens.shape[0] // n_sweep)[:, None]
+            for tries in (self.boost_tries, self.ban_tries):
+                if len(tries) not in (0, 1, n_audio // n_sweep):
+                    raise ValueError(
+                        f"{len(tries)} dictionaries given for {n_audio // n_sweep} audio"
+                    )
+            # the beams of audio i are rows i * beam_size to (i + 1) * beam_size - 1
+            if self.boost:
+                self.boost_cursor = DictTrieCursor(
+                    self.boost_tries * n_sweep, tokens.shape[0], logits.device
+                )
+            if self.ban:
+                self.ban_cursor = DictTrieCursor(
+                    self.ban_tries * n_sweep, tokens.shape[0], logits.device
+                )
 
+        # STEP 1: calculate the cumulative log probabilities for possible candidates, all at once
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        next_tokens, source_indices, finished_sequences = [], [], []
-        for i in range(n_audio):
-            (
-                scores,
-                seq_dict_scores,
-                seq_ban_dict_scores,
-                total_scores,
-                sources,
-                finished,
-            ) = (
-                {},
-                {},
-                {},
-                {},
-                {},
-                {},
+        n_candidates = 3 * self.beam_size + 1
+        top_logprobs, top_tokens = logprobs.topk(n_candidates)  # (n_batch, n_candidates)
+        scores = sum_logprobs[:, None] + top_logprobs
+        temp_scores = torch.zeros_like(scores)
+        if self.boost:
+            perma_boost_scores, temp_boost_scores = self.boost_cursor.advance(
+                top_tokens, top_logprobs
             )
-            self.logger.debug(f"============== at a new time step, Beam size: {self.beam_size} ==============")
-            self.logger.debug(f"Reading dictionary with tokenizer: language={self.tokenizer.language}")
-            self.logger.debug(f"Tokenizer name: {self.tokenizer.encoding.name}")
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
+            scores = scores - self.boost_scale * perma_boost_scores
+            temp_scores = temp_scores + self.boost_scale * temp_boost_scores
+        if self.ban:
+            perma_ban_scores, temp_ban_scores = self.ban_cursor.advance(
+                top_tokens, top_logprobs
+            )
+            scores = scores - self.ban_coeff * perma_ban_scores
+            temp_scores = temp_scores + self.ban_coeff * temp_ban_scores
+        total_scores = scores - temp_scores
+
+        prefixes = [tuple(prefix) for prefix in tokens.tolist()]
+        top_tokens_list = top_tokens.tolist()
+        if self.ngram:
+            ngram_scores = [
+                [
+                    self.ngram.get_score(list(prefix) + [token])
+                    for token in top_tokens_list[idx]
+                ]
+                for idx, prefix in enumerate(prefixes)
+            ]
+            total_scores = total_scores - self.ngram_coeff * torch.tensor(
+                ngram_scores, device=total_scores.device
+            )
+
+        if self.trace == "full":
+            self._trace_candidates(prefixes, sum_logprobs, top_logprobs, top_tokens, scores)
+
+        # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
+        scores_list = scores.tolist()
+        if self.prune_margin is not None:
+            total_scores_list = total_scores.tolist()
+        next_tokens, source_indices, selected, finished_sequences = [], [], [], []
+
+        def add_dead_beams(n: int, idx: int, candidate_idx: int):
+            # copies of a candidate scored -inf, which fill the rows of pruned or stopped beams
+            sequence = prefixes[idx] + (top_tokens_list[idx][candidate_idx],)
+            for _ in range(n):
+                sum_logprobs[len(next_tokens)] = -np.inf
+                next_tokens.append(sequence)
+                source_indices.append(idx)
+                selected.append(idx * n_candidates + candidate_idx)
+
+        for i in range(n_audio):
+            saved, finished, seen = 0, {}, set()
+            if i in self.stopped:
+                add_dead_beams(self.beam_size, i * self.beam_size, 0)
+                finished_sequences.append(finished)
+                continue
+
+            beams = slice(i * self.beam_size, (i + 1) * self.beam_size)
+            # stable, so tied candidates keep their order, as with sorted() over a dict
+            ranking = total_scores[beams].flatten().argsort(descending=True, stable=True).tolist()
+            best_live, floor = None, None
+            for rank in ranking:
+                j, candidate_idx = divmod(rank, n_candidates)
                 idx = i * self.beam_size + j
-                
-                # Check bounds before accessing
-                if idx >= tokens.shape[0]:
-                    self.logger.error(f"Index {idx} out of bounds for tokens with shape {tokens.shape}")
-                    continue  # Skip this iteration instead of crashing
-                
-                prefix = tokens[idx].tolist()
-                self.logger.debug("-----------------------------------------------")
-                self.logger.debug(f"Beam {j+1}, Prefix: {self.tokenizer.decode(prefix[3:])}, Sum Log: {sum_logprobs[idx]:.3f}")
-                # print(logprobs[idx].size())
-                for candidate_idx, (logprob, token) in enumerate(zip(*logprobs[idx].topk(3 * self.beam_size + 1))):
-                    # for logprob, token in zip(*logprobs[idx].topk(logprobs[idx].shape[-1])):
-                    new_logprob = (sum_logprobs[idx] + logprob).item() # logprob is the log probability of the token, sum_logprobs[idx] is the cumulative log probability of the prefix
-                    sequence = tuple(prefix + [token.item()]) # sequence is the prefix + the token
-                    new_dict_logprob = dict_logprobs[idx] + [logprob.item()] # new_dict_logprob is the cumulative log probability of the prefix + the token
-                    new_ban_dict_logprob = ban_dict_logprobs[idx] + [logprob.item()]
-                    self.logger.debug(f"Expanded candidate {candidate_idx +1}/{3 * self.beam_size + 1}: {self.tokenizer.decode([token.item()])} => {logprob.item():.2f}")
-                    # We advance current word in dictionary in trie by check if current sequence exists
-                    dictionary_sequence = sequence[-len(new_dict_logprob) :]
-                    temp_boost_score = 0
-                    # debugger 
-                    dictionary_sequence_decoded = self.tokenizer.decode(list(dictionary_sequence))
-                    self.logger.debug(f"Check if [{dictionary_sequence}:{dictionary_sequence_decoded}] is in boost dictionary {self.boost_dictionary.next_at_sequence} -> {dictionary_sequence}")
-                    if (
-                        dictionary_sequence
-                        not in self.boost_dictionary.next_at_sequence
-                    ):
-                        # If the current sequence does not exist, we find a suffix of current sequence which matches
-                        # a prefix of words in dictionary
-                        if tuple(prefix) in self.boost_dictionary.next_at_sequence:
-                            backoff_sequence = (
-                                self.boost_dictionary.backoff_at_sequence[tuple(prefix)]
-                            )
-                            potential_suffix = backoff_sequence + (token.item(),)
-                            while (
-                                potential_suffix
-                                not in self.boost_dictionary.next_at_sequence
-                            ):
-                                backoff_sequence = (
-                                    self.boost_dictionary.backoff_at_sequence[
-                                        backoff_sequence
-                                    ]
-                                )
-                                potential_suffix = backoff_sequence + (token.item(),)
-                                # If we satifies this condition, it means that the current sequence does not match any word in dictionary
-                                if (
-                                    backoff_sequence
-                                    == self.boost_dictionary.backoff_at_sequence[
-                                        backoff_sequence
-                                    ]
-                                ):
-                                    break
-                            dictionary_sequence = potential_suffix
-                            if (
-                                dictionary_sequence
-                                not in self.boost_dictionary.next_at_sequence
-                            ):
-                                dictionary_sequence = tuple()
-                        else:
-                            dictionary_sequence = tuple()
-
-                    if len(dictionary_sequence) == 0: # if dictionary_sequence is empty, we don't need to calculate the boost score
-                        new_dict_logprob = []
-                    else: # if dictionary_sequence is not empty, we calculate the boost score
-                        self.logger.debug(f"⭐️ current logprob (prefix + new token): {[f'{x:.2f}' for x in new_dict_logprob]}")
-                        new_dict_logprob = new_dict_logprob[-len(dictionary_sequence) :]
-                        perma_boost_score = 0
-                        for i, end_length in enumerate(self.boost_dictionary.end_at_sequence[
-                            dictionary_sequence
-                        ]):
-                            perma_boost_score += sum(new_dict_logprob[-end_length:])
-                            self.logger.debug(f"⭐️ {i} perma_boost_score: {perma_boost_score:.2f} = {perma_boost_score:.2f} + cumulative log({new_dict_logprob[-end_length:]})")
-                        new_logprob = new_logprob - self.boost_coeff * perma_boost_score
-                        self.logger.debug(f"⭐️ result - whole seq logprob: {new_logprob:.3f} = {new_logprob:.3f} - {self.boost_coeff:.3f} * {perma_boost_score:.3f}")
-                        if (
-                            len(
-                                self.boost_dictionary.next_at_sequence[
-                                    dictionary_sequence
-                                ]
-                            )
-                            > 0
-                        ):
-                            temp_boost_score = sum(new_dict_logprob)
-                            self.logger.debug(f"⭐️ new_dict_logprob: {new_dict_logprob}, temp_boost_score: {temp_boost_score}")
-                            # matched with dictionary debugger
-                            matched_word = self.tokenizer.decode(list(dictionary_sequence))
-                            self.logger.debug(f"⭐️ matched_word: {matched_word}")
-
-                    ban_dictionary_sequence = sequence[-len(new_ban_dict_logprob) :]
-                    temp_ban_score = 0
-                    if (
-                        ban_dictionary_sequence
-                        not in self.ban_dictionary.next_at_sequence
-                    ):
-                        # If the current sequence does not exist, we find a suffix of current sequence which matches
-                        # a prefix of words in dictionary
-                        if tuple(prefix) in self.ban_dictionary.next_at_sequence:
-                            backoff_sequence = self.ban_dictionary.backoff_at_sequence[
-                                tuple(prefix)
-                            ]
-                            potential_suffix = backoff_sequence + (token.item(),)
-                            while (
-                                potential_suffix
-                                not in self.ban_dictionary.next_at_sequence
-                            ):
-                                backoff_sequence = (
-                                    self.ban_dictionary.backoff_at_sequence[
-                                        backoff_sequence
-                                    ]
-                                )
-                                potential_suffix = backoff_sequence + (token.item(),)
-                                # If we satifies this condition, it means that the current sequence does not match any word in dictionary
-                                if (
-                                    backoff_sequence
-                                    == self.ban_dictionary.backoff_at_sequence[
-                                        backoff_sequence
-                                    ]
-                                ):
-                                    break
-                            ban_dictionary_sequence = potential_suffix
-                            if (
-                                ban_dictionary_sequence
-                                not in self.ban_dictionary.next_at_sequence
-                            ):
-                                ban_dictionary_sequence = tuple()
-                        else:
-                            ban_dictionary_sequence = tuple()
-
-                    if len(ban_dictionary_sequence) == 0:
-                        new_ban_dict_logprob = []
-                    else:
-                        new_ban_dict_logprob = new_ban_dict_logprob[
-                            -len(ban_dictionary_sequence) :
-                        ]
-                        perma_ban_score = 0
-                        for end_length in self.ban_dictionary.end_at_sequence[
-                            ban_dictionary_sequence
-                        ]:
-                            perma_ban_score += sum(new_ban_dict_logprob[-end_length:])
-                        new_logprob = new_logprob - self.ban_coeff * perma_ban_score
-                        if (
-                            len(
-                                self.ban_dictionary.next_at_sequence[
-                                    ban_dictionary_sequence
-                                ]
-                            )
-                            > 0
-                        ):
-                            temp_ban_score = sum(new_ban_dict_logprob)
-
-                    total_scores[sequence] = (
-                        new_logprob
-                        - self.boost_coeff * temp_boost_score
-                        - self.ban_coeff * temp_ban_score
-                    )
-                    if self.ngram:
-                        total_scores[sequence] = total_scores[
-                            sequence
-                        ] - self.ngram_coeff * self.ngram.get_score(list(sequence))
-                    seq_dict_scores[sequence] = new_dict_logprob
-                    seq_ban_dict_scores[sequence] = new_ban_dict_logprob
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
-
-            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
-            saved = 0
-            for sequence in sorted(total_scores, key=total_scores.get, reverse=True):
+                if self.prune_margin is not None:
+                    # the candidates are ranked, so all the following ones are below the floor too
+                    if floor is None:
+                        floor = total_scores_list[idx][candidate_idx] - self.prune_margin
+                    elif total_scores_list[idx][candidate_idx] < floor:
+                        break
+                sequence = prefixes[idx] + (top_tokens_list[idx][candidate_idx],)
+                # beams with the same prefix, like at the first step, expand to the same sequences
+                if sequence in seen:
+                    continue
+                seen.add(sequence)
+
                 if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
+                    finished[sequence] = scores_list[idx][candidate_idx]
                 else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    dict_logprobs[len(next_tokens)] = seq_dict_scores[sequence]
-                    ban_dict_logprobs[len(next_tokens)] = seq_ban_dict_scores[sequence]
+                    sum_logprobs[len(next_tokens)] = scores_list[idx][candidate_idx]
                     next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
+                    source_indices.append(idx)
+                    selected.append(idx * n_candidates + candidate_idx)
+                    if best_live is None:
+                        best_live = (idx, candidate_idx)
 
                     saved += 1
                     if saved == self.beam_size:
                         break
 
+            if saved < self.beam_size:
+                # every candidate left was pruned; without any live beam, the audio stops
+                if best_live is None:
+                    self.stopped.add(i)
+                    if self.trace != "off":
+                        self._trace("stopped", step=self.n_steps, audio=i)
+                    best_live = divmod(ranking[0], n_candidates)
+                    best_live = (i * self.beam_size + best_live[0], best_live[1])
+                add_dead_beams(self.beam_size - saved, *best_live)
             finished_sequences.append(finished)
-        # added debugger
-        for i, finished_sequence in enumerate(finished_sequences):
-            decoded_sequences = []
-            for seq in finished_sequence.keys():
-                decoded_sequences.append(self.tokenizer.decode(list(seq)))
-            self.logger.debug(f"Finished sequences: {', '.join(decoded_sequences)}")
+        if self.trace != "off":
+            for i, finished_sequence in enumerate(finished_sequences):
+                if finished_sequence:
+                    self._trace(
+                        "finished",
+                        step=self.n_steps,
+                        audio=i,
+                        texts=[
+                            self.tokenizer.decode(list(seq))
+                            for seq in finished_sequence
+                        ],
+                        scores=list(finished_sequence.values()),
+                    )
+        self.n_steps += 1
 
         tokens = torch.tensor(next_tokens, device=tokens.device)
         self.inference.rearrange_kv_cache(source_indices)
+        selected = torch.tensor(selected, device=logits.device)
+        if self.boost:
+            self.boost_cursor.update(selected)
+        if self.ban:
+            self.ban_cursor.update(selected)
 
         # add newly finished sequences to self.finished_sequences
         assert len(self.finished_sequences) == len(finished_sequences)
@@ -778,21 +1289,47 @@ class BeamSearchDecoder(TokenDecoder):
                     break  # the candidate list is full
                 previously_finished[seq] = newly_finished[seq]
 
-        # mark as completed if all audio has enough number of samples
+        # stop the audio whose best finished sequence can no longer be overtaken by a live beam,
+        # assuming each would end at the next step, where its length penalty is the smallest
+        if self.stop_bound is not None:
+            live_logprobs = sum_logprobs.tolist()
+            for i, sequences in enumerate(self.finished_sequences):
+                if i in self.stopped or not sequences:
+                    continue
+                best_finished = max(
+                    self._normalized(score, len(seq) - self.sample_begin - 1)
+                    for seq, score in sequences.items()
+                )
+                best_live = max(
+                    self._normalized(live_logprobs[k], len(next_tokens[k]) - self.sample_begin)
+                    for k in range(i * self.beam_size, (i + 1) * self.beam_size)
+                )
+                if best_finished >= best_live + self.stop_bound:
+                    self.stopped.add(i)
+                    if self.trace != "off":
+                        self._trace("stopped", step=self.n_steps, audio=i)
+
+        # mark as completed if all audio has enough number of samples, or has stopped
         completed = all(
-            len(sequences) >= self.max_candidates
-            for sequences in self.finished_sequences
+            len(sequences) >= self.max_candidates or i in self.stopped
+            for i, sequences in enumerate(self.finished_sequences)
         )
         return tokens, completed
 
+    def _normalized(self, logprob: float, length: int) -> float:
+        return length_normalized(logprob, max(length, 1), self.length_penalty)
+
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
         sum_logprobs = sum_logprobs.cpu()
         for i, sequences in enumerate(self.finished_sequences):
             if (
-                len(sequences) < self.beam_size
-            ):  # when not enough sequences are finished
+                len(sequences) < self.beam_size and i not in self.stopped
+            ):  # when not enough sequences are finished, unless the rest were pruned
                 for j in list(np.argsort(sum_logprobs[i]))[::-1]:
+                    # the -inf rows of pruned beams copy a live beam, whose score they would replace
+                    if sum_logprobs[i][j] == -np.inf:
+                        break
                     sequence = preceding_tokens[i, j].tolist() + [self.eot]
                     sequences[tuple(sequence)] = sum_logprobs[i][j].item()
                     if len(sequences) >= self.beam_size:
@@ -943,6 +1480,14 @@ class DecodingTask:
         # inference: implements the forward pass through the decoder, including kv caching
         self.inference = PyTorchInference(model, len(self.initial_tokens))
 
+        # feature cache: reuses the encoder output of audio seen by a previous decode;
+        # only models loaded by name can be told apart in the cache
+        self.feature_cache: Optional[AudioFeatureCache] = None
+        if options.feature_cache_dir and getattr(model, "name", None):
+            self.feature_cache = get_audio_feature_cache(
+                os.path.abspath(options.feature_cache_dir), options.feature_cache_size
+            )
+
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
 
@@ -961,6 +1506,12 @@ class DecodingTask:
                 options.ngram_path,
                 options.ngram_coeff,
                 options.transcription_file,
+                options.trace,
+                options.trace_file,
+                self.sample_begin,
+                options.length_penalty,
+                options.beam_stop_bound,
+                options.beam_prune_margin,
             )
         else:
             self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
@@ -996,6 +1547,19 @@ class DecodingTask:
             0 <= options.length_penalty <= 1
         ):
             raise ValueError("length_penalty (alpha) should be a value between 0 and 1")
+        if isinstance(options.dict_coeff, (list, tuple)):
+            if len(options.dict_coeff) == 0:
+                raise ValueError("dict_coeff should list at least one coefficient")
+            if options.beam_size is None:
+                raise ValueError("a sweep over dict_coeff values requires beam search")
+        if (
+            options.beam_stop_bound is not None or options.beam_prune_margin is not None
+        ) and options.beam_size is None:
+            raise ValueError("beam_stop_bound and beam_prune_margin require beam_size to be given")
+        if options.beam_prune_margin is not None and options.beam_prune_margin < 0:
+            raise ValueError("beam_prune_margin should not be negative")
+        if options.trace not in ("off", "summary", "full"):
+            raise ValueError(f"trace should be one of off, summary or full, got {options.trace}")
 
         return options
 
@@ -1066,6 +1630,8 @@ class DecodingTask:
         ):
             # encoded audio features are given; skip audio encoding
             audio_features = mel
+        elif self.feature_cache is not None:
+            audio_features = self._get_cached_audio_features(mel)
         else:
             audio_features = self.model.encoder(mel)
 
@@ -1078,6 +1644,26 @@ class DecodingTask:
 
         return audio_features
 
+    def _get_cached_audio_features(self, mel: Tensor) -> Tensor:
+        # run the encoder only on the audio missing from the cache
+        keys = [
+            self.feature_cache.key(audio, self.model.name, self.options.fp16)
+            for audio in mel
+        ]
+        features = [self.feature_cache.get(key) for key in keys]
+        features = [
+            None if cached is None else torch.from_numpy(np.array(cached)).to(mel.device)
+            for cached in features
+        ]
+        missing = [i for i, cached in enumerate(features) if cached is None]
+        if missing:
+            encoded = self.model.encoder(mel[missing])
+            for i, audio_features in zip(missing, encoded):
+                features[i] = audio_features
+                self.feature_cache.put(keys[i], audio_features.cpu().numpy())
+
+        return torch.stack(features)
+
     def _detect_language(self, audio_features: Tensor, tokens: Tensor):
         languages = [self.options.language] * audio_features.shape[0]
         lang_probs = None
@@ -1096,8 +1682,6 @@ class DecodingTask:
         n_batch = tokens.shape[0]
         sum_logprobs: Tensor = torch.zeros(n_batch, device=audio_features.device)
         no_speech_probs = [np.nan] * n_batch
-        boost_dict_logprobs: List[List[float]] = [[] for _ in range(n_batch)]
-        ban_dict_logprobs: List[List[float]] = [[] for _ in range(n_batch)]
         try:
             for i in range(self.sample_len):
                 logits = self.inference.logits(tokens, audio_features)
@@ -1116,9 +1700,7 @@ class DecodingTask:
                     logit_filter.apply(logits, tokens)
 
                 # expand the tokens tensor with the selected next tokens
-                tokens, completed = self.decoder.update(
-                    tokens, logits, sum_logprobs, boost_dict_logprobs, ban_dict_logprobs
-                )
+                tokens, completed = self.decoder.update(tokens, logits, sum_logprobs)
 
                 if completed or tokens.shape[-1] > self.n_ctx:
                     break
@@ -1134,6 +1716,13 @@ class DecodingTask:
         n_audio: int = mel.shape[0]
 
         audio_features: Tensor = self._get_audio_features(mel)  # encoder forward pass
+
+        # for a sweep over dict_coeff values, decode the audio once per coefficient,
+        # sharing the encoder output: the results are ordered by coefficient, then by audio
+        if isinstance(self.options.dict_coeff, (list, tuple)):
+            audio_features = audio_features.repeat(len(self.options.dict_coeff), 1, 1)
+            n_audio = audio_features.shape[0]
+
         tokens: Tensor = torch.tensor([self.initial_tokens]).repeat(n_audio, 1)
 
         # detect language if requested, overwriting the language token
@@ -1151,11 +1740,12 @@ class DecodingTask:
         # repeat text tensors by the group size, for beam search or best-of-n sampling
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
 
-        # call the main sampling loop
-        tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
+        # call the main sampling loop, with the audio features repeated like the text tensors
+        tokens, sum_logprobs, no_speech_probs = self._main_loop(
+            audio_features.repeat_interleave(self.n_group, dim=0), tokens
+        )
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
-        audio_features = audio_features[:: self.n_group]
         no_speech_probs = no_speech_probs[:: self.n_group]
         assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
@@ -1238,6 +1828,8 @@ def decode(
 
     if kwargs:
         options = replace(options, **kwargs)
+    if isinstance(options.dict_coeff, (list, tuple)):
+        single = False  # one result per coefficient
 
     # print("--------------------------------decoding started")
     # print("Decoding options", options)
@@ -139,6 +139,70 @@ class MultiHeadAttention(nn.Module):
         return out, qk
 
 
+class KVCache(dict):
+    """
+    The `kv_cache` of the text decoder, mapping each key/value projection module to its cache.
+
+    The self-attention keys and values are written into a buffer of `n_ctx` positions per module,
+    allocated on the first forward pass, and the cache holds a view of its filled part; so each
+    new token is copied once instead of the whole cache. Cross-attention keys and values, which
+    are longer than `n_ctx`, are saved as-is. `rearrange` reorders the buffers for beam search
+    into a second buffer per module, which then takes the place of the first.
+    """
+
+    def __init__(self, n_ctx: int, cache: Optional[dict] = None):
+        super().__init__(cache or {})
+        self.n_ctx = n_ctx
+        self.buffers: Dict[nn.Module, Tensor] = {}
+        self.spares: Dict[nn.Module, Tensor] = {}
+        self.lengths: Dict[nn.Module, int] = {}
+        self.views: Dict[nn.Module, Tensor] = {}
+
+    def _update_view(self, module: nn.Module) -> Tensor:
+        view = self.buffers[module][:, : self.lengths[module]]
+        self[module] = self.views[module] = view
+        return view
+
+    def save(self, module: nn.Module, output: Tensor) -> Tensor:
+        if output.shape[1] > self.n_ctx:
+            # save as-is, for cross attention
+            self[module] = output
+            return output
+
+        cached = self.get(module)
+        if cached is None or cached is not self.views.get(module):
+            # first token, or a cache given or replaced from outside: copy it into a new buffer
+            n_batch, _, n_state = output.shape
+            self.buffers[module] = output.new_empty(n_batch, self.n_ctx, n_state)
+            self.spares.pop(module, None)
+            self.lengths[module] = 0
+            if cached is not None:
+                self.buffers[module][:, : cached.shape[1]] = cached
+                self.lengths[module] = cached.shape[1]
+
+        start = self.lengths[module]
+        self.buffers[module][:, start : start + output.shape[1]] = output.detach()
+        self.lengths[module] = start + output.shape[1]
+        return self._update_view(module)
+
+    def rearrange(self, source_indices) -> None:
+        """Select the batch rows `source_indices` of every self-attention key and value"""
+        for module, buffer in self.buffers.items():
+            index = torch.as_tensor(source_indices, device=buffer.device)
+            length = self.lengths[module]
+            if len(index) != buffer.shape[0]:
+                # the batch size changes, so the buffers cannot be reused
+                self.buffers[module] = buffer[index]
+                self.spares.pop(module, None)
+            else:
+                if module not in self.spares:
+                    self.spares[module] = torch.empty_like(buffer)
+                spare = self.spares[module]
+                torch.index_select(buffer[:, :length], 0, index, out=spare[:, :length])
+                self.buffers[module], self.spares[module] = spare, buffer
+            self._update_view(module)
+
+
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, n_state: int, n_head: int, cross_attention: bool = False):
         super().__init__()
@@ -284,6 +348,29 @@ class Whisper(nn.Module):
         )
         self.register_buffer("alignment_heads", mask.to_sparse(), persistent=False)
 
+    def quantize_int8(self) -> "Whisper":
+        """
+        Replace every `Linear` layer with a dynamically quantized int8 one, in place, for faster
+        inference on CPU; activations are quantized on the fly, so no calibration data is needed
+        """
+        # quantize_dynamic only converts modules whose type is exactly nn.Linear
+        for module in list(self.modules()):
+            for name, child in list(module.named_children()):
+                if type(child) is Linear:
+                    linear = nn.Linear(
+                        child.in_features,
+                        child.out_features,
+                        bias=child.bias is not None,
+                        device="meta",
+                    )
+                    linear.weight = child.weight
+                    linear.bias = child.bias
+                    setattr(module, name, linear)
+
+        return torch.ao.quantization.quantize_dynamic(
+            self, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
@@ -316,21 +403,16 @@ class Whisper(nn.Module):
 
         Returns
         -------
-        cache : Dict[nn.Module, torch.Tensor]
+        cache : KVCache
             A dictionary object mapping the key/value projection modules to its cache
         hooks : List[RemovableHandle]
             List of PyTorch RemovableHandle objects to stop the hooks to be called
         """
-        cache = {**cache} if cache is not None else {}
+        cache = KVCache(self.dims.n_text_ctx, cache)
         hooks = []
 
         def save_to_cache(module, _, output):
-            if module not in cache or output.shape[1] > self.dims.n_text_ctx:
-                # save as-is, for the first token or cross attention
-                cache[module] = output
-            else:
-                cache[module] = torch.cat([cache[module], output], dim=1).detach()
-            return cache[module]
+            return cache.save(module, output)
 
         def install_hooks(layer: nn.Module):
             if isinstance(layer, MultiHeadAttention):
@@ -1,9 +1,12 @@
+import atexit
 import json
 import os
+import queue
 import re
 import sys
+import threading
 import zlib
-from typing import Callable, List, Optional, TextIO
+from typing import Callable, Dict, List, Optional, TextIO
 
 system_encoding = sys.getdefaultencoding()
 
@@ -316,3 +319,54 @@ def get_writer(
         return write_all
 
     return writers[output_format](output_dir)
+
+
+class TraceWriter:
+    """
+    Append-only JSON Lines sink for decoding traces. Records are queued by the decoder and
+    serialized by a background thread into a single buffered file, which is flushed whenever
+    the queue runs empty.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8", buffering=1 << 16)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, record: dict):
+        self.queue.put(record)
+
+    def _run(self):
+        while (record := self.queue.get()) is not None:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+_trace_writers: Dict[str, TraceWriter] = {}
+_trace_writers_lock = threading.Lock()
+
+
+def get_trace_writer(path: str) -> TraceWriter:
+    """Return the trace writer appending to `path`, opening the file on first use"""
+    path = os.path.abspath(path)
+    with _trace_writers_lock:
+        if path not in _trace_writers:
+            _trace_writers[path] = TraceWriter(path)
+        return _trace_writers[path]
+
+
+@atexit.register
+def close_trace_writers():
+    with _trace_writers_lock:
+        for writer in _trace_writers.values():
+            writer.close()
+        _trace_writers.clear()